@@ -1,4 +1,13 @@
-from flask import Blueprint, request, jsonify, abort
+from flask import (
+    Blueprint,
+    request,
+    jsonify,
+    abort,
+    send_file,
+    current_app,
+    make_response,
+    stream_with_context,
+)
 from http import HTTPStatus
 from functools import wraps
 from flask_jwt_extended import (
@@ -9,14 +18,33 @@ from flask_jwt_extended import (
     current_user,
 )
 from flask_cors import cross_origin
-from models import db, User, BlogPost, Comment, Contact
+from models import db, User, BlogPost, Comment, Contact, Image, File
 from forms import RegisterForm, LoginForm, CommentForm, ContactForm, CreatePostForm
 from datetime import datetime, timedelta
-from util import get_jkt_timezone, row2dict
+from sqlalchemy import exc, func, or_
+from sqlalchemy.orm import defer
+from util import get_jkt_timezone
+from util.serializers import serialize, get_serializer, json_response
+from util.blob_store import blob_store
+from util.cache import TTLCache
+from util import search, backup
+from .chat.util import format_timestamp
+from util.view_counter import view_counter
+from util.metrics import metrics, instrument_blueprint
+import hashlib
 import re
 import os
 
 api = Blueprint("api", __name__)
+instrument_blueprint(api)
+
+ABOUT_POST_ID = 1
+POSTS_PAGE_SIZE = 20
+MAX_POSTS_PAGE_SIZE = 100
+COMMENTS_PAGE_SIZE = 20
+MAX_COMMENTS_PAGE_SIZE = 100
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
 
 
 def check_admin():
@@ -38,6 +66,80 @@ def admin_only(f):
     return wrapped_function
 
 
+# (endpoint, args, is admin) -> (body, etag, mimetype)
+response_cache = TTLCache(maxsize=512, ttl=300, name="responses")
+
+
+def cached_response(by_admin=True, ttl_config="RESPONSE_CACHE_TTL"):
+    """Cache successful responses per endpoint and query arguments (and
+    admin-ness when ``by_admin``), send them with a strong ETag and answer
+    matching If-None-Match requests with 304. Entries live for the seconds
+    in ``app.config[ttl_config]`` or until ``response_cache.clear()``, which
+    every write to posts or comments has to call. The cache is per process,
+    so other workers may serve an old response until their entry expires."""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapped_function(*args, **kwargs):
+            key = (
+                request.endpoint,
+                tuple(sorted(request.args.items(multi=True))),
+                by_admin and check_admin(),
+            )
+            entry = response_cache.get(key)
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != HTTPStatus.OK:
+                    return response
+                body = response.get_data()
+                entry = (body, hashlib.sha256(body).hexdigest(), response.mimetype)
+                response_cache.set(key, entry, current_app.config[ttl_config])
+            body, etag, mimetype = entry
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            if by_admin:
+                response.vary.add("Authorization")
+            return response.make_conditional(request)
+
+        return wrapped_function
+
+    return decorator
+
+
+def get_comments_page(post_id, cursor=None, limit=COMMENTS_PAGE_SIZE):
+    """Return the comments of a post after ``cursor`` (oldest first) with their
+    authors joined in, and the cursor of the next page"""
+    query = (
+        db.session.query(Comment.id, Comment.text, User.email, User.name)
+        .outerjoin(User, Comment.author_id == User.id)
+        .filter(Comment.post_id == post_id)
+    )
+    if cursor:
+        query = query.filter(Comment.id > cursor)
+    rows = query.order_by(Comment.id).limit(limit + 1).all()
+    comments = []
+    for comment_id, text, email, name in rows[:limit]:
+        comments.append(
+            {"id": comment_id, "author": {"email": email, "name": name}, "text": text}
+        )
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return comments, next_cursor
+
+
+def send_blob(row, as_attachment=False):
+    """Stream an Image or File from the blob store. send_file answers Range and
+    If-None-Match requests and hands the file to wsgi.file_wrapper (sendfile),
+    or to the front server when USE_X_SENDFILE is set."""
+    return send_file(
+        blob_store.path(row.digest),
+        mimetype=row.mimetype,
+        as_attachment=as_attachment,
+        download_name=row.filename,
+        conditional=True,
+        etag=row.digest,
+    )
+
+
 def get_form(form_class):
     data = request.form
     if not data:
@@ -57,6 +159,9 @@ def sign_up():
     username = form.username.data
     email = form.email.data
     password = form.password.data
+    if db.session.query(User.id).filter_by(email=email).first():
+        error = {"email": ["Email is already registered."]}
+        return {"error": error}, HTTPStatus.BAD_REQUEST
     new_user = User(username, email, password)
     access_token = create_access_token(identity=new_user)
     refresh_token = create_refresh_token(identity=new_user)
@@ -65,7 +170,7 @@ def sign_up():
             "success": "User created",
             "access_token": access_token,
             "refresh_token": refresh_token,
-            "user": row2dict(new_user, ["password", "is_online"]),
+            "user": serialize(new_user, ["password", "is_online"]),
         }
     )
     db.session.add(new_user)
@@ -82,13 +187,15 @@ def login():
     user = User.query.filter_by(email=form.email.data).first()
     if not user or not user.check_password(form.password.data):
         return {"error": "Email or password is wrong."}, HTTPStatus.UNAUTHORIZED
+    if user.rehash_password(form.password.data):
+        db.session.commit()
     access_token = create_access_token(identity=user)
     refresh_token = create_refresh_token(identity=user)
     response = jsonify(
         success="login success",
         access_token=access_token,
         refresh_token=refresh_token,
-        user=row2dict(user, ["password", "is_online"]),
+        user=serialize(user, ["password", "is_online"]),
     )
     return response, HTTPStatus.OK
 
@@ -110,6 +217,7 @@ def refresh():
 
 @api.route("/home/title", methods=["GET"])
 @cross_origin()
+@cached_response(by_admin=False)
 def get_home_title():
     img_url = os.environ.get(
         "HOME_IMG_URL",
@@ -123,46 +231,87 @@ def get_home_title():
 @api.route("/home/posts", methods=["GET"])
 @jwt_required(True)
 @cross_origin()
+@cached_response()
 def get_all_posts():
-    posts = BlogPost.query.order_by(BlogPost.id.desc()).all()
-    if posts:
-        del posts[-1]
-    print(current_user)
+    cursor = request.args.get("cursor", type=int)
+    limit = request.args.get("limit", POSTS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_POSTS_PAGE_SIZE))
+    query = (
+        db.session.query(BlogPost, User.name)
+        .outerjoin(User, BlogPost.author_id == User.id)
+        .options(defer(BlogPost.body), defer(BlogPost.img_url))
+        .filter(BlogPost.id != ABOUT_POST_ID)
+    )
     if not check_admin():
-        posts = [post for post in posts if not post.hidden]
+        query = query.filter(or_(BlogPost.hidden.is_(None), BlogPost.hidden == False))
+    if cursor:
+        query = query.filter(BlogPost.id < cursor)
+    rows = query.order_by(BlogPost.id.desc()).limit(limit + 1).all()
+    serialize_post = get_serializer(
+        BlogPost, ("hidden", "author_id", "body", "img_url")
+    )
     posts_list = []
-    for post in posts:
-        data = row2dict(post, hidden_column=["hidden", "author_id", "body", "img_url"])
-        data["author"] = post.author.name
+    for post, author_name in rows[:limit]:
+        data = serialize_post(post)
+        data["author"] = author_name
         posts_list.append(data)
-    return jsonify(posts=posts_list)
+    next_cursor = rows[limit - 1][0].id if len(rows) > limit else None
+    return json_response({"posts": posts_list, "next_cursor": next_cursor})
 
 
 @api.route("/post", methods=["GET"])
 @jwt_required(True)
 @cross_origin()
 def get_post():
+    response = render_post()
+    if response.status_code in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED):
+        if not check_admin():
+            view_counter.add(int(request.args["id"]))
+    return response
+
+
+# The view count is part of the response, so cached posts are refreshed as
+# often as buffered views are written
+@cached_response(ttl_config="VIEW_FLUSH_INTERVAL")
+def render_post():
     id = request.args.get("id")
     if not id:
         return jsonify(error="invalid request"), HTTPStatus.BAD_REQUEST
     if id == 1:
         return jsonify(error="id invalid"), HTTPStatus.NOT_FOUND
     requested_post = BlogPost.query.get_or_404(id)
-    if not check_admin():
-        if requested_post.hidden:
-            return jsonify(error="id invalid"), HTTPStatus.NOT_FOUND
-        if not requested_post.views:
-            requested_post.views = 0
-        requested_post.views += 1
-        db.session.commit()
-    response = row2dict(requested_post, hidden_column=["hidden"])
-    response["comments"] = []
-    for comment in requested_post.comments:
-        data = {}
-        data["author"] = comment.comment_author.get_safe_dict()
-        data["text"] = comment.text
-        response["comments"].append(data)
-    return response
+    if requested_post.hidden and not check_admin():
+        return jsonify(error="id invalid"), HTTPStatus.NOT_FOUND
+    response = serialize(requested_post, ["hidden"])
+    response["views"] = (requested_post.views or 0) + view_counter.pending(
+        requested_post.id
+    )
+    comments, next_cursor = get_comments_page(requested_post.id)
+    response["comments"] = comments
+    response["next_comment_cursor"] = next_cursor
+    response["comment_count"] = (
+        db.session.query(func.count(Comment.id))
+        .filter(Comment.post_id == requested_post.id)
+        .scalar()
+    )
+    return json_response(response)
+
+
+@api.route("/post/comment", methods=["GET"])
+@jwt_required(True)
+@cross_origin()
+def get_post_comments():
+    id = request.args.get("id", type=int)
+    if not id:
+        return jsonify(error="invalid request"), HTTPStatus.BAD_REQUEST
+    hidden = db.session.query(BlogPost.hidden).filter(BlogPost.id == id).first()
+    if not hidden or (hidden[0] and not check_admin()):
+        return jsonify(error="id invalid"), HTTPStatus.NOT_FOUND
+    cursor = request.args.get("cursor", type=int)
+    limit = request.args.get("limit", COMMENTS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_COMMENTS_PAGE_SIZE))
+    comments, next_cursor = get_comments_page(id, cursor, limit)
+    return json_response({"comments": comments, "next_cursor": next_cursor})
 
 
 @api.route("/post", methods=["POST"])
@@ -188,6 +337,7 @@ def create_post():
     )
     db.session.add(new_post)
     db.session.commit()
+    response_cache.clear()
     return jsonify(id=new_post.id)
 
 
@@ -214,6 +364,7 @@ def edit_post():
     requested_post.img_url = form.img_url.data
     requested_post.body = form.body.data
     db.session.commit()
+    response_cache.clear()
     return jsonify(success="success", id=requested_post.id)
 
 
@@ -239,17 +390,75 @@ def comment_post():
     form = get_form(CommentForm)
     if not form.validate():
         return jsonify(error=form.errors), HTTPStatus.BAD_REQUEST
-    comment = Comment(author_id=current_user.id, post_id=id, text=form.text.data)
+    comment = Comment(
+        author_id=current_user.id, post_id=id, text=form.comment_text.data
+    )
     db.session.add(comment)
     db.session.commit()
+    response_cache.clear()
     return jsonify(success="comment success")
 
 
 @api.route("/about")
 @cross_origin()
+@cached_response(by_admin=False)
 def about():
-    post = BlogPost.query.get(1)
-    return row2dict(post, ["hidden", "id", "author_id"])
+    post = BlogPost.query.get(ABOUT_POST_ID)
+    return json_response(serialize(post, ["hidden", "id", "author_id"]))
+
+
+def get_search_args():
+    """Return the words, limit and offset of a search request"""
+    words = search.get_words(request.args.get("q"))
+    page = max(1, request.args.get("page", 1, type=int))
+    limit = request.args.get("limit", SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    return words, page, limit
+
+
+@api.route("/search/posts")
+@jwt_required(True)
+@cross_origin()
+def search_posts():
+    words, page, limit = get_search_args()
+    if not words:
+        return jsonify(error="invalid request"), HTTPStatus.BAD_REQUEST
+    rows = search.search_posts(
+        words,
+        include_hidden=check_admin(),
+        exclude_ids=[ABOUT_POST_ID],
+        limit=limit + 1,
+        offset=(page - 1) * limit,
+    )
+    posts = [dict(row) for row in rows[:limit]]
+    next_page = page + 1 if len(rows) > limit else None
+    return json_response({"posts": posts, "next_page": next_page})
+
+
+@api.route("/search/chats")
+@jwt_required()
+@cross_origin()
+def search_chats():
+    words, page, limit = get_search_args()
+    if not words:
+        return jsonify(error="invalid request"), HTTPStatus.BAD_REQUEST
+    rows = search.search_chats(
+        words, current_user.id, limit=limit + 1, offset=(page - 1) * limit
+    )
+    chats = []
+    for row in rows[:limit]:
+        chats.append(
+            {
+                "id": row.id,
+                "room_id": row.room_id,
+                "room_name": row.room_name,
+                "msg": row.message,
+                "username": row.username,
+                "time": format_timestamp(row.created_at),
+            }
+        )
+    next_page = page + 1 if len(rows) > limit else None
+    return json_response({"chats": chats, "next_page": next_page})
 
 
 @api.route("/contact", methods=["POST"])
@@ -276,3 +485,65 @@ def contact():
 @jwt_required()
 def api_check_admin():
     return jsonify(is_admin=check_admin())
+
+
+@api.route("/metrics")
+@cross_origin()
+@jwt_required()
+@admin_only
+def get_metrics():
+    return current_app.response_class(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+@api.route("/export")
+@cross_origin()
+@jwt_required()
+@admin_only
+def export_content():
+    """Stream every post and comment as NDJSON, see util/backup.py"""
+    response = current_app.response_class(
+        stream_with_context(backup.export_lines()), mimetype="application/x-ndjson"
+    )
+    response.headers["Content-Disposition"] = "attachment; filename=blog.ndjson"
+    return response
+
+
+@api.route("/import", methods=["POST"])
+@cross_origin()
+@jwt_required()
+@admin_only
+def import_content():
+    """Insert the posts and comments of an /export body in one transaction"""
+    batches = []
+
+    def on_batch(kind, rows, total):
+        batches.append({"type": kind, "rows": rows, "total": total})
+        current_app.logger.info("Imported %d %ss, %d so far", rows, kind, total)
+
+    try:
+        totals = backup.import_lines(request.stream, on_batch=on_batch)
+    except backup.InvalidRecord as e:
+        return jsonify(error=str(e)), HTTPStatus.BAD_REQUEST
+    except exc.IntegrityError as e:
+        return jsonify(error=str(e.orig)), HTTPStatus.CONFLICT
+    response_cache.clear()
+    return jsonify(imported=totals, batches=batches)
+
+
+@api.route("/image/<filename>")
+@cross_origin()
+def get_image(filename):
+    image = Image.query.filter_by(filename=filename).first_or_404()
+    return send_blob(image)
+
+
+@api.route("/file/<int:id>")
+@cross_origin()
+@jwt_required()
+def get_file(id):
+    file = File.query.get_or_404(id)
+    if file.owner_id != current_user.id and not check_admin():
+        return jsonify(error="id invalid"), HTTPStatus.NOT_FOUND
+    return send_blob(file, as_attachment=True)
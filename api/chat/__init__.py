@@ -5,16 +5,63 @@ from flask_socketio import (
     ConnectionRefusedError,
     join_room,
     leave_room,
-    rooms,
 )
 from flask_jwt_extended import jwt_required, current_user
 from models import db, ChatRoom, RoomRead, Chat, User, Image
 from flask import request
 from datetime import datetime
-from ..chat import util
+from ..chat import util, images
+from .write_behind import chat_writer
+from .group_calls import group_calls
+from util.metrics import metrics, InstrumentedSocketIO
 import io
 
-socketio = SocketIO(cors_allowed_origins="*")
+socketio = InstrumentedSocketIO(cors_allowed_origins="*")
+
+
+def count_connected_sockets():
+    if not socketio.server:
+        return {}
+    namespaces = socketio.server.manager.rooms
+    return {
+        (namespace,): len(namespace_rooms.get(None, ()))
+        for namespace, namespace_rooms in namespaces.items()
+    }
+
+
+metrics.gauge(
+    "socketio_connected_sockets",
+    "Sockets connected to this worker",
+    ("namespace",),
+    count_connected_sockets,
+)
+metrics.gauge(
+    "presence_socket_users",
+    "Entries in socket_users",
+    (),
+    lambda: {(): len(util.socket_users)},
+)
+metrics.gauge(
+    "presence_call_users",
+    "Entries in call_users",
+    (),
+    lambda: {(): len(util.call_users)},
+)
+metrics.gauge(
+    "presence_group_call_participants",
+    "Sids in group calls",
+    (),
+    lambda: {(): len(group_calls.participants)},
+)
+
+
+def flush_chats():
+    """Write queued chats before reading the room, a failed write is retried
+    by the flusher and must not break loading history"""
+    try:
+        chat_writer.flush()
+    except Exception as e:
+        print("Failed to write queued chats:", e)
 
 
 @socketio.on("connect", namespace="/chat")
@@ -23,24 +70,13 @@ def socket_connect():
     current_user.is_online = True
     util.add_socket_user(request.sid, current_user.id)
     rooms = []
-    for assoc in current_user.chat_rooms:
+    for assoc, num_unread in util.get_rooms_unread(current_user.id):
         assoc.is_to_email = False
-        room = assoc.chat_room
-        room_name = assoc.room_name
-        num_unread = 0
-        for chat in room.chats:
-            if chat:
-                if chat.time and assoc.last_read:
-                    if util.timestamp_get_datetime(
-                        chat.time
-                    ) > util.timestamp_get_datetime(assoc.last_read):
-                        num_unread += 1
-        if num_unread == 0:
-            assoc.is_read = True
+        assoc.is_read = num_unread == 0
         rooms.append(
             {
-                "room_id": room.id,
-                "name": room_name,
+                "room_id": assoc.room_id,
+                "name": assoc.room_name,
                 "is_read": assoc.is_read,
                 "num_unread": num_unread,
             }
@@ -73,18 +109,19 @@ def on_message(data):
     username = user.name
     room_id = str(data["room"]["room_id"])
 
-    chat_room = ChatRoom.query.get(room_id)
-    chat = Chat(message=msg, time=util.get_timestamp(), user=user, room=chat_room)
-    util.modified_update(chat_room)
-    for assoc in chat_room.members:
-        assoc.is_read = assoc.user_id == user.id
-    db.session.add(chat)
+    if chat_writer.enabled:
+        if user.id not in util.get_room_member_ids(int(room_id)):
+            return
+        created_at = chat_writer.add(int(room_id), user.id, msg)
+    else:
+        chat_room = ChatRoom.query.get(room_id)
+        created_at = util.add_chat(chat_room, user, msg).created_at
     emit(
         "message",
         {
             "username": username,
             "msg": msg,
-            "time": util.get_timestamp(),
+            "time": util.format_timestamp(created_at),
             "id": request.sid,
         },
         room=room_id,
@@ -105,11 +142,11 @@ def on_message(data):
 
 @socketio.on("read", namespace="/chat")
 def read_callback(data):
+    flush_chats()
     assoc = RoomRead.query.filter_by(
         room_id=data, user_id=util.get_user_id(request.sid)
     ).first()
-    assoc.is_read = True
-    assoc.last_read = util.get_timestamp()
+    util.mark_read(assoc)
     db.session.commit()
 
 
@@ -119,33 +156,37 @@ def on_join(data):
     user_id = util.get_user_id(request.sid)
     room_id = str(data["room_id"])
     join_room(room_id)
+    flush_chats()
     room = ChatRoom.query.get(room_id)
     assoc = RoomRead.query.filter_by(user_id=user_id, room_id=room_id).first()
-    assoc.is_read = True
-    assoc.last_read = util.get_timestamp()
+    util.mark_read(assoc)
     db.session.commit()
-    chats = room.chats
-    chat_list = []
-    for chat in chats:
-        chat_dict = {
-            "msg": chat.message,
-            "time": chat.time,
-            "is_user": chat.user_id == user_id,
-            "username": chat.user.name,
-            "is_image": chat.is_image,
-        }
-        chat_list.append(chat_dict)
+    chat_list, has_more = util.get_chat_history(room_id, user_id)
     if room.is_group:
-        chat_list.append(
-            {
-                "msg": chats[0].message,
-                "time": chats[0].time,
-                "is_user": False,
-                "username": "Server",
-            }
-        )
+        first_chat = room.chats.order_by(Chat.id).first()
+        if first_chat:
+            chat_list.append(
+                {
+                    "msg": first_chat.message,
+                    "time": util.format_timestamp(first_chat.created_at),
+                    "is_user": False,
+                    "username": "Server",
+                }
+            )
     # Broadcast that new user has joined
-    emit("show_history", {"chats": chat_list})
+    emit("show_history", {"chats": chat_list, "has_more": has_more})
+
+
+@socketio.on("load_more", namespace="/chat")
+def on_load_more(data):
+    """Send the page of history older than data["before_id"], or the newest
+    page when it is left out"""
+    user_id = util.get_user_id(request.sid)
+    room_id = str(data["room_id"])
+    if not RoomRead.query.filter_by(user_id=user_id, room_id=room_id).first():
+        return
+    chat_list, has_more = util.get_chat_history(room_id, user_id, data.get("before_id"))
+    emit("more_history", {"chats": chat_list, "has_more": has_more})
 
 
 @socketio.on("leave", namespace="/chat")
@@ -158,18 +199,53 @@ def on_leave(data):
 
 @socketio.on("upload-img", namespace="/chat")
 def upload_image(data):
-    print(data)
+    """Store an uploaded image and send it to the room as an image chat"""
+    user = util.get_user_from_sid(request.sid)
+    room_id = str(data["room"]["room_id"])
+    if not user or user.id not in util.get_room_member_ids(int(room_id)):
+        return
+    try:
+        filename = images.save_upload(data["img"])
+    except images.UploadError as e:
+        emit("upload_error", str(e))
+        return
+    message = images.image_url(filename)
+    if chat_writer.enabled:
+        # Queued behind the text messages so chat ids keep arrival order
+        created_at = chat_writer.add(int(room_id), user.id, message, is_image=True)
+    else:
+        chat_room = ChatRoom.query.get(room_id)
+        created_at = util.add_chat(chat_room, user, message, is_image=True).created_at
+    emit(
+        "message",
+        {
+            "username": user.name,
+            "msg": message,
+            "time": util.format_timestamp(created_at),
+            "id": request.sid,
+            "is_image": True,
+            "thumb": images.image_url(images.thumbnail_name(filename)),
+        },
+        room=room_id,
+    )
+    util.notify_chat(socketio, int(room_id))
+    db.session.commit()
 
 
 @socketio.on("connect", namespace="/call")
 @jwt_required()
 def connect_call():
     print(current_user.name, "connected to call")
-    util.add_call_user(request.sid, current_user.id)
+    util.add_call_user(
+        request.sid,
+        current_user.id,
+        current_user.name,
+        util.get_friend_ids(current_user.id),
+    )
     emit("socket_id", request.sid)
     friends_online = util.get_call_friends_online(request.sid)
     emit("friends_online", friends_online)
-    for friend in util.get_call_friends_online(request.sid):
+    for friend in friends_online:
         emit(
             "friend_online",
             {"sid": request.sid, "name": current_user.name},
@@ -179,10 +255,10 @@ def connect_call():
 
 @socketio.on("call_user", namespace="/call")
 def socket_call_user(data):
-    user = util.get_call_user(request.sid)
+    name = util.call_users[request.sid]["name"]
     emit(
         "call_user",
-        {"from": request.sid, "name": user.name, "signal": data["signal"]},
+        {"from": request.sid, "name": name, "signal": data["signal"]},
         room=data["user_to_call"],
     )
 
@@ -251,25 +327,31 @@ def leave_call(data):
 @socketio.on("join_room", namespace="/groupcall")
 def join_group_call(data):
     group_name = data
+    result = group_calls.join(request.sid, group_name)
+    if result is None:
+        emit("room_full", group_name)
+        return
     join_room(group_name)
-    result = util.join_group_call(request.sid, group_name)
     print(result)
     emit("all_users", result)
 
 
 @socketio.on("disconnect", namespace="/groupcall")
 def disconnect_group_call():
-    for room in rooms():
-        if room != request.sid:
-            util.leave_group_call(request.sid, room)
-            emit("leave_group", request.sid, room=room)
+    for room in group_calls.leave_all(request.sid):
+        emit("leave_group", request.sid, room=room)
 
 
 @socketio.on("leave_room", namespace="/groupcall")
 def leave_group_call(data):
     leave_room(data)
-    util.leave_group_call(request.sid, data)
-    emit("leave_group", request.sid, room=data)
+    if group_calls.leave(request.sid, data):
+        emit("leave_group", request.sid, room=data)
+
+
+@socketio.on("heartbeat", namespace="/groupcall")
+def group_call_heartbeat(data=None):
+    group_calls.touch(request.sid)
 
 
 @socketio.on("sending_signal", namespace="/groupcall")
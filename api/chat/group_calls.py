@@ -0,0 +1,150 @@
+"""Group call rooms: who is in which call, capped and reaped.
+
+Membership lives in the presence registry (see ``api/chat/registry.py``) in
+two places: an insertion-ordered set of sids per room, so joining, leaving
+and membership checks don't scan a list and ``all_users`` comes back in join
+order, and one ``Participant`` per sid with its rooms and when it was last
+seen, so a disconnect leaves exactly the rooms the sid joined.
+
+Rooms are capped at ``GROUP_CALL_MAX_MEMBERS``, every member opens a peer
+connection to every other one. With several workers two joins can race past
+the cap by one, it is a guard against runaway rooms rather than a quota.
+
+A sid that goes away without a clean disconnect (its worker was killed or
+crashed before the handler ran) would otherwise stay in its rooms
+for good. Every ``GROUP_CALL_TTL / 2`` seconds each worker marks the sids
+still connected to it as seen, and participants nobody has seen for
+``GROUP_CALL_TTL`` seconds are removed and their rooms told they left.
+Clients can also emit ``heartbeat`` to mark themselves seen.
+"""
+
+import os
+import threading
+import time
+from .registry import registry
+
+NAMESPACE = "/groupcall"
+
+
+class Participant:
+    __slots__ = ("sid", "rooms", "last_seen")
+
+    def __init__(self, sid, rooms=(), last_seen=None):
+        self.sid = sid
+        self.rooms = list(rooms)
+        self.last_seen = time.time() if last_seen is None else last_seen
+
+    def dump(self):
+        return [self.rooms, self.last_seen]
+
+
+class GroupCalls:
+    def __init__(self):
+        self.rooms = registry.set_map("group_calls")
+        self.participants = registry.hash("group_call_participants")
+        self.max_members = 8
+        self.ttl = 60
+        self.reaper_pid = None
+
+    def init_app(self, app):
+        self.max_members = app.config["GROUP_CALL_MAX_MEMBERS"]
+        self.ttl = app.config["GROUP_CALL_TTL"]
+        self.start()
+
+    def start(self):
+        """Start this process's reaper. A worker forked from a preloaded app
+        has to call it again, see gunicorn.conf.py."""
+        if self.reaper_pid != os.getpid():
+            self.reaper_pid = os.getpid()
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def get(self, sid):
+        value = self.participants.get(sid)
+        return Participant(sid, *value) if value else None
+
+    def save(self, participant):
+        self.participants[participant.sid] = participant.dump()
+
+    def members(self, room):
+        return self.rooms.members(room)
+
+    def join(self, sid, room):
+        """Add the sid to the room, return the sids already in it, or None if
+        the room is full"""
+        rejoin = self.rooms.has(room, sid)
+        members = self.rooms.members(room)
+        if rejoin:
+            members.remove(sid)
+        elif len(members) >= self.max_members:
+            return None
+        self.rooms.add(room, sid)
+        participant = self.get(sid) or Participant(sid)
+        if room not in participant.rooms:
+            participant.rooms.append(room)
+        participant.last_seen = time.time()
+        self.save(participant)
+        return members
+
+    def leave(self, sid, room):
+        """Remove the sid from the room, return whether it was in it"""
+        removed = self.rooms.discard(room, sid)
+        participant = self.get(sid)
+        if participant and room in participant.rooms:
+            participant.rooms.remove(room)
+            if participant.rooms:
+                self.save(participant)
+            else:
+                self.participants.pop(sid, None)
+        return removed
+
+    def leave_all(self, sid):
+        """Remove the sid from all its rooms, return those rooms"""
+        participant = self.get(sid)
+        if not participant:
+            return []
+        for room in participant.rooms:
+            self.rooms.discard(room, sid)
+        self.participants.pop(sid, None)
+        return participant.rooms
+
+    def touch(self, sid):
+        participant = self.get(sid)
+        if participant:
+            participant.last_seen = time.time()
+            self.save(participant)
+
+    def reap(self, is_connected=None):
+        """Mark the sids is_connected(sid) accepts as seen, remove the ones
+        not seen for ttl seconds, return {sid: rooms} of the removed ones"""
+        now = time.time()
+        reaped = {}
+        for sid, value in self.participants.items():
+            participant = Participant(sid, *value)
+            if is_connected and is_connected(sid):
+                participant.last_seen = now
+                self.save(participant)
+            elif now - participant.last_seen > self.ttl:
+                reaped[sid] = self.leave_all(sid)
+        return reaped
+
+    def run(self):
+        from . import socketio
+
+        def is_connected(sid):
+            return socketio.server.manager.is_connected(sid, NAMESPACE)
+
+        pid = os.getpid()
+        # A reaper inherited through fork stops, the child starts its own
+        while self.reaper_pid == pid == os.getpid():
+            time.sleep(self.ttl / 2)
+            try:
+                for sid, rooms in self.reap(is_connected).items():
+                    for room in rooms:
+                        socketio.emit(
+                            "leave_group", sid, room=room, namespace=NAMESPACE
+                        )
+            except Exception as e:
+                print("Failed to reap group call participants:", e)
+
+
+group_calls = GroupCalls()
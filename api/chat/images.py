@@ -0,0 +1,94 @@
+"""Chat image uploads: decode, resize and JPEG encode on a worker thread, then
+store the full image and a thumbnail in the blob store."""
+
+from collections import OrderedDict
+import base64
+import binascii
+import hashlib
+import io
+from models import db, Image
+from util.blob_store import blob_store
+from util.offload import WorkerPool
+from .util import JPEGSaveWithTargetSize, thumbnail_name
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_DIMENSION = 1920
+IMAGE_TARGET_BYTES = 300 * 1024
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_TARGET_BYTES = 30 * 1024
+VARIANT_CACHE_SIZE = 256
+
+image_pool = WorkerPool("images", 2)
+
+# sha256 of the uploaded bytes -> {"full": (digest, size), "thumb": (digest, size)}
+variant_cache = OrderedDict()
+
+
+class UploadError(ValueError):
+    pass
+
+
+def decode_payload(data):
+    """Accept raw bytes (socket.io binary) or a base64 data URL, return the
+    bytes and their sha256"""
+    if isinstance(data, str):
+        try:
+            data = base64.b64decode(data.split(",", 1)[-1], validate=True)
+        except (binascii.Error, ValueError):
+            raise UploadError("Invalid image data")
+    if not isinstance(data, (bytes, bytearray)) or not data:
+        raise UploadError("Invalid image data")
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise UploadError("Image is too large")
+    return bytes(data), hashlib.sha256(data).hexdigest()
+
+
+def encode_variants(raw):
+    """Runs on a worker thread"""
+    # Imported here, Pillow is only needed once someone uploads an image
+    from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
+
+    try:
+        im = PILImage.open(io.BytesIO(raw))
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+    except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError):
+        raise UploadError("Invalid image")
+    thumb = im.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE)
+    return {
+        "full": blob_store.put(JPEGSaveWithTargetSize(im, IMAGE_TARGET_BYTES)),
+        "thumb": blob_store.put(JPEGSaveWithTargetSize(thumb, THUMBNAIL_TARGET_BYTES)),
+    }
+
+
+def get_variants(payload):
+    raw, source = image_pool.run(decode_payload, payload)
+    variants = variant_cache.get(source)
+    if variants and all(blob_store.exists(digest) for digest, _ in variants.values()):
+        variant_cache.move_to_end(source)
+        return source, variants
+    variants = image_pool.run(encode_variants, raw)
+    variant_cache[source] = variants
+    if len(variant_cache) > VARIANT_CACHE_SIZE:
+        variant_cache.popitem(last=False)
+    return source, variants
+
+
+def image_url(filename):
+    return f"/api/image/{filename}"
+
+
+def save_upload(payload):
+    """Process the upload and add its Image rows, return the image filename"""
+    source, variants = get_variants(payload)
+    filename = f"{source[:32]}.jpg"
+    if not db.session.query(Image.id).filter_by(filename=filename).first():
+        for name, (digest, size) in (
+            (filename, variants["full"]),
+            (thumbnail_name(filename), variants["thumb"]),
+        ):
+            db.session.add(
+                Image(filename=name, digest=digest, size=size, mimetype="image/jpeg")
+            )
+    return filename
@@ -0,0 +1,84 @@
+"""Message queue wiring so ``emit`` reaches clients connected to other workers.
+
+``SOCKETIO_MESSAGE_QUEUE`` accepts anything Flask-SocketIO understands
+(``redis://``, ``amqp://``, ``kafka://``, ``zmq+tcp://``). ``sqlite:///path``
+selects ``SQLiteManager``, a polling stand-in for running several workers on
+one machine (or in tests) without a broker.
+"""
+
+import os
+import sqlite3
+import time
+
+import socketio as python_socketio
+
+
+class SQLiteManager(python_socketio.PubSubManager):
+    name = "sqlite"
+
+    def __init__(
+        self,
+        url,
+        channel="flask-socketio",
+        write_only=False,
+        logger=None,
+        poll_interval=0.05,
+        retention=60,
+    ):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len("sqlite:///") :]
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.pid = None
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Connect on first use in each process, so workers forked from a
+        # preloaded master each get their own connection and start reading
+        # at the messages published after they started
+        if self.pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS socketio_messages "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, data TEXT, "
+                "created REAL)"
+            )
+            self.last_id = self._conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM socketio_messages"
+            ).fetchone()[0]
+            self.pid = os.getpid()
+        return self._conn
+
+    def _publish(self, data):
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO socketio_messages (channel, data, created) VALUES (?, ?, ?)",
+            (self.channel, self.json.dumps(data), now),
+        )
+        self.conn.execute(
+            "DELETE FROM socketio_messages WHERE created < ?", (now - self.retention,)
+        )
+
+    def _listen(self):
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, data FROM socketio_messages "
+                "WHERE channel = ? AND id > ? ORDER BY id",
+                (self.channel, self.last_id),
+            ).fetchall()
+            for self.last_id, data in rows:
+                yield data
+            self.server.sleep(self.poll_interval)
+
+
+def get_options(url):
+    """Keyword arguments for ``socketio.init_app`` for the given queue url"""
+    if not url:
+        return {}
+    if url.startswith("sqlite:///"):
+        return {"client_manager": SQLiteManager(url)}
+    return {"message_queue": url}
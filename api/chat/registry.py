@@ -0,0 +1,413 @@
+"""Presence/session state shared by the socket.io handlers.
+
+The chat, call and group call handlers keep who-is-connected-where state in a
+few named hashes and set maps. By default they live in process memory, which
+only works with a single worker. Pointing ``PRESENCE_REGISTRY_URL`` at a shared
+backend (``redis://...`` or, on a single host, ``sqlite:///path``) lets several
+workers or nodes see the same state. Cross-process ``emit`` additionally needs
+``SOCKETIO_MESSAGE_QUEUE``, see ``api.chat.message_queue``.
+
+A worker that is restarted or crashes never runs its disconnect handlers, so
+a shared backend would keep its sids forever. Every sid is therefore tracked
+with the id of the worker holding it, and each worker writes a heartbeat
+every ``PRESENCE_WORKER_TTL / 3`` seconds. Sids of workers whose heartbeat
+is older than ``PRESENCE_WORKER_TTL`` are handed to the ``on_stale_sid``
+callbacks and forgotten.
+"""
+
+from collections.abc import MutableMapping
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class MemoryBackend:
+    def __init__(self):
+        self.hashes = {}
+        self.sets = {}
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, {})[key] = value
+
+    def hdel(self, name, key):
+        return self.hashes.get(name, {}).pop(key, None) is not None
+
+    def hitems(self, name):
+        return list(self.hashes.get(name, {}).items())
+
+    def hlen(self, name):
+        return len(self.hashes.get(name, {}))
+
+    def sadd(self, name, key, *members):
+        # dicts keep insertion order, so they double as ordered sets
+        members_dict = self.sets.setdefault(name, {}).setdefault(key, {})
+        for member in members:
+            members_dict[member] = None
+
+    def srem(self, name, key, member):
+        members = self.sets.get(name, {}).get(key)
+        if members is None or member not in members:
+            return False
+        del members[member]
+        if not members:
+            del self.sets[name][key]
+        return True
+
+    def smembers(self, name, key):
+        return list(self.sets.get(name, {}).get(key, ()))
+
+    def sismember(self, name, key, member):
+        return member in self.sets.get(name, {}).get(key, ())
+
+    def sexists(self, name, key):
+        return key in self.sets.get(name, {})
+
+    def sdel(self, name, key):
+        self.sets.get(name, {}).pop(key, None)
+
+    def skeys(self, name):
+        return list(self.sets.get(name, {}))
+
+    def clear(self):
+        self.hashes.clear()
+        self.sets.clear()
+
+
+class SQLiteBackend:
+    """Registry in a SQLite file, shared by the worker processes of one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Connect on first use in each process, a forked worker must not share
+        # the connection of the process that created the app
+        if self.pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS registry_hash "
+                "(name TEXT, key TEXT, value TEXT, PRIMARY KEY (name, key))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS registry_set "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, key TEXT, "
+                "member TEXT, UNIQUE (name, key, member))"
+            )
+            self.pid = os.getpid()
+        return self._conn
+
+    def hget(self, name, key):
+        row = self.conn.execute(
+            "SELECT value FROM registry_hash WHERE name = ? AND key = ?", (name, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def hset(self, name, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO registry_hash VALUES (?, ?, ?)",
+            (name, key, json.dumps(value)),
+        )
+
+    def hdel(self, name, key):
+        cursor = self.conn.execute(
+            "DELETE FROM registry_hash WHERE name = ? AND key = ?", (name, key)
+        )
+        return cursor.rowcount > 0
+
+    def hitems(self, name):
+        rows = self.conn.execute(
+            "SELECT key, value FROM registry_hash WHERE name = ?", (name,)
+        )
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def hlen(self, name):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM registry_hash WHERE name = ?", (name,)
+        ).fetchone()[0]
+
+    def sadd(self, name, key, *members):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO registry_set (name, key, member) VALUES (?, ?, ?)",
+            [(name, key, json.dumps(member)) for member in members],
+        )
+
+    def srem(self, name, key, member):
+        cursor = self.conn.execute(
+            "DELETE FROM registry_set WHERE name = ? AND key = ? AND member = ?",
+            (name, key, json.dumps(member)),
+        )
+        return cursor.rowcount > 0
+
+    def smembers(self, name, key):
+        rows = self.conn.execute(
+            "SELECT member FROM registry_set WHERE name = ? AND key = ? ORDER BY id",
+            (name, key),
+        )
+        return [json.loads(member) for member, in rows]
+
+    def sismember(self, name, key, member):
+        # Answered from the UNIQUE (name, key, member) index
+        row = self.conn.execute(
+            "SELECT 1 FROM registry_set WHERE name = ? AND key = ? AND member = ?",
+            (name, key, json.dumps(member)),
+        ).fetchone()
+        return row is not None
+
+    def sexists(self, name, key):
+        row = self.conn.execute(
+            "SELECT 1 FROM registry_set WHERE name = ? AND key = ? LIMIT 1",
+            (name, key),
+        ).fetchone()
+        return row is not None
+
+    def sdel(self, name, key):
+        self.conn.execute(
+            "DELETE FROM registry_set WHERE name = ? AND key = ?", (name, key)
+        )
+
+    def skeys(self, name):
+        rows = self.conn.execute(
+            "SELECT DISTINCT key FROM registry_set WHERE name = ?", (name,)
+        )
+        return [key for key, in rows]
+
+    def clear(self):
+        self.conn.execute("DELETE FROM registry_hash")
+        self.conn.execute("DELETE FROM registry_set")
+
+
+class RedisBackend:
+    def __init__(self, url, prefix="registry"):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _hash(self, name):
+        return f"{self.prefix}:hash:{name}"
+
+    def _set(self, name, key):
+        return f"{self.prefix}:set:{name}:{key}"
+
+    def hget(self, name, key):
+        value = self.redis.hget(self._hash(name), key)
+        return json.loads(value) if value is not None else None
+
+    def hset(self, name, key, value):
+        self.redis.hset(self._hash(name), key, json.dumps(value))
+
+    def hdel(self, name, key):
+        return self.redis.hdel(self._hash(name), key) > 0
+
+    def hitems(self, name):
+        return [
+            (key.decode(), json.loads(value))
+            for key, value in self.redis.hgetall(self._hash(name)).items()
+        ]
+
+    def hlen(self, name):
+        return self.redis.hlen(self._hash(name))
+
+    def sadd(self, name, key, *members):
+        # sorted sets scored by insertion time keep members in join order
+        now = time.time()
+        mapping = {json.dumps(member): now for member in members}
+        self.redis.zadd(self._set(name, key), mapping, nx=True)
+
+    def srem(self, name, key, member):
+        return self.redis.zrem(self._set(name, key), json.dumps(member)) > 0
+
+    def smembers(self, name, key):
+        return [
+            json.loads(member)
+            for member in self.redis.zrange(self._set(name, key), 0, -1)
+        ]
+
+    def sismember(self, name, key, member):
+        return self.redis.zscore(self._set(name, key), json.dumps(member)) is not None
+
+    def sexists(self, name, key):
+        return self.redis.exists(self._set(name, key)) > 0
+
+    def sdel(self, name, key):
+        self.redis.delete(self._set(name, key))
+
+    def skeys(self, name):
+        prefix = self._set(name, "")
+        return [
+            key.decode()[len(prefix) :]
+            for key in self.redis.scan_iter(match=prefix + "*")
+        ]
+
+    def clear(self):
+        for key in self.redis.scan_iter(match=self.prefix + ":*"):
+            self.redis.delete(key)
+
+
+def make_backend(url):
+    if not url or url.startswith("memory:"):
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///") :])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported presence registry url: {url}")
+
+
+class Hash(MutableMapping):
+    """Dict-like view of a named hash in the registry (keys are stored as str)"""
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __getitem__(self, key):
+        value = self.registry.backend.hget(self.name, str(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.registry.backend.hset(self.name, str(key), value)
+
+    def __delitem__(self, key):
+        if not self.registry.backend.hdel(self.name, str(key)):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter([key for key, _ in self.registry.backend.hitems(self.name)])
+
+    def __len__(self):
+        return self.registry.backend.hlen(self.name)
+
+    def items(self):
+        return self.registry.backend.hitems(self.name)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class SetMap:
+    """Named mapping of key -> insertion-ordered set of members"""
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def add(self, key, *members):
+        if members:
+            self.registry.backend.sadd(self.name, str(key), *members)
+
+    def discard(self, key, member):
+        return self.registry.backend.srem(self.name, str(key), member)
+
+    def members(self, key):
+        return self.registry.backend.smembers(self.name, str(key))
+
+    def has(self, key, member):
+        return self.registry.backend.sismember(self.name, str(key), member)
+
+    def pop(self, key):
+        self.registry.backend.sdel(self.name, str(key))
+
+    def keys(self):
+        return self.registry.backend.skeys(self.name)
+
+    def __contains__(self, key):
+        return self.registry.backend.sexists(self.name, str(key))
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class Registry:
+    def __init__(self):
+        self.backend = MemoryBackend()
+        self.worker_ttl = 30
+        self.worker_id = None
+        self.worker_pid = None
+        self.workers = self.hash("workers")
+        self.sid_workers = self.hash("sid_workers")
+        self.stale_sid_callbacks = []
+
+    def init_app(self, app):
+        self.backend = make_backend(app.config.get("PRESENCE_REGISTRY_URL"))
+        self.worker_ttl = app.config["PRESENCE_WORKER_TTL"]
+        self.start()
+
+    def start(self):
+        """Register this process as a worker and start its heartbeat. A worker
+        forked from a preloaded app has to call it again, see gunicorn.conf.py."""
+        if self.worker_pid != os.getpid():
+            self.worker_pid = os.getpid()
+            self.worker_id = (
+                f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            )
+            self.workers[self.worker_id] = time.time()
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def on_stale_sid(self, f):
+        """Register f(sid) to forget a sid whose worker died"""
+        self.stale_sid_callbacks.append(f)
+        return f
+
+    def track(self, sid):
+        self.sid_workers[sid] = self.worker_id
+
+    def untrack(self, sid):
+        self.sid_workers.pop(sid, None)
+
+    def sweep(self):
+        """Write this worker's heartbeat and forget the sids of dead workers,
+        return those sids"""
+        now = time.time()
+        self.workers[self.worker_id] = now
+        alive = set()
+        for worker_id, last_seen in self.workers.items():
+            if now - last_seen > self.worker_ttl:
+                self.workers.pop(worker_id, None)
+            else:
+                alive.add(worker_id)
+        stale = [
+            sid for sid, worker_id in self.sid_workers.items() if worker_id not in alive
+        ]
+        for sid in stale:
+            for callback in self.stale_sid_callbacks:
+                callback(sid)
+            self.untrack(sid)
+        return stale
+
+    def run(self):
+        pid = os.getpid()
+        # A heartbeat inherited through fork stops, the child starts its own
+        while self.worker_pid == pid == os.getpid():
+            time.sleep(self.worker_ttl / 3)
+            try:
+                self.sweep()
+            except Exception as e:
+                print("Failed to sweep the presence registry:", e)
+
+    def hash(self, name):
+        return Hash(self, name)
+
+    def set_map(self, name):
+        return SetMap(self, name)
+
+
+registry = Registry()
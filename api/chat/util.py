@@ -1,16 +1,33 @@
-from util import get_jkt_timezone
+from util import get_jkt_timezone, to_jkt_timezone
 from datetime import datetime
-from models import RoomRead, User, db, ChatRoom, Image
+from models import RoomRead, User, db, ChatRoom, Image, Chat, user_friends
+from sqlalchemy import and_, func
+from util.blob_store import release_blobs
+from .registry import registry
 import io
-import math
+import os
 
-socket_users = {}
-call_users = {}
-group_calls = {}
+CHAT_PAGE_SIZE = 50
+
+# Presence state lives in the registry so several workers can share it, see
+# api/chat/registry.py
+socket_users = registry.hash("socket_users")
+call_users = registry.hash("call_users")
+
+# Fanout index for chat notifications: user id -> live /chat sids, and
+# room id -> member user ids (filled from room_read the first time a room is
+# notified, then kept in sync by make_room_read and delete_group_from_db)
+user_sids = registry.set_map("user_sids")
+room_members = registry.set_map("room_members")
+
+# Presence index for the /call namespace: user id -> its current call sid
+call_user_sids = registry.hash("call_user_sids")
 
 
 def add_socket_user(sid, user_id):
     socket_users[sid] = user_id
+    user_sids.add(user_id, sid)
+    registry.track(sid)
     print(socket_users)
 
 
@@ -24,24 +41,63 @@ def get_user_id(sid):
 
 def remove_socket_user(sid):
     try:
-        del socket_users[sid]
+        user_id = socket_users.pop(sid)
     except KeyError:
         return
+    user_sids.discard(user_id, sid)
+    registry.untrack(sid)
+
+
+def get_room_member_ids(room_id):
+    members = room_members.members(room_id)
+    if not members:
+        members = [
+            user_id
+            for user_id, in db.session.query(RoomRead.user_id).filter_by(
+                room_id=room_id
+            )
+        ]
+        room_members.add(room_id, *members)
+    return members
+
+
+def add_room_member(assoc):
+    room_id = assoc.room_id or assoc.chat_room.id
+    user_id = assoc.user_id or assoc.member.id
+    if room_id in room_members and user_id:
+        room_members.add(room_id, user_id)
 
 
-def add_call_user(sid, user_id):
-    call_users_copy = call_users.copy()
-    for other_sid, user in call_users_copy.items():
-        if user["id"] == user_id:
-            del call_users[other_sid]
+def remove_room_members(room_id):
+    room_members.pop(room_id)
+
+
+def add_call_user(sid, user_id, name=None, friend_ids=()):
+    other_sid = call_user_sids.get(user_id)
+    if other_sid:
+        call_users.pop(other_sid, None)
+        registry.untrack(other_sid)
+    call_user_sids[user_id] = sid
+    registry.track(sid)
     call_users[sid] = {
         "id": user_id,
+        "name": name,
+        "friend_ids": list(friend_ids),
         "is_call": False,
         "call_id": None,
         "is_answered": False,
     }
 
 
+def get_friend_ids(user_id):
+    return [
+        friend_id
+        for friend_id, in db.session.query(user_friends.c.friend_id).filter(
+            user_friends.c.user_id == user_id
+        )
+    ]
+
+
 def get_call_user(sid):
     return User.query.get(call_users.get(sid)["id"])
 
@@ -55,49 +111,28 @@ def set_user_call_to(sid, call_id):
     if user:
         user["is_call"] = True
         user["call_id"] = False
+        call_users[sid] = user
 
 
 def set_answer_call(sid, call_id):
-    user1 = call_users.get(sid)
-    user2 = call_users.get(call_id)
-    if user1:
-        user1["is_answered"] = True
-    if user2:
-        user2["is_answered"] = True
+    for call_sid in (sid, call_id):
+        user = call_users.get(call_sid)
+        if user:
+            user["is_answered"] = True
+            call_users[call_sid] = user
 
 
 def get_call_friends_online(sid):
-    try:
-        call_users_copy = call_users.copy()
-        user = User.query.get(call_users[sid]["id"])
-        friends_online = []
-        for other_sid, user_data in call_users_copy.items():
-            if other_sid != sid:
-                other_user = User.query.get(user_data["id"])
-                if other_user in user.friends:
-                    friends_online.append({"name": other_user.name, "sid": other_sid})
-        return friends_online
-    except KeyError:
+    user_data = call_users.get(sid)
+    if not user_data:
         return []
-
-
-def join_group_call(sid, group_name):
-    if not group_name in group_calls:
-        group_calls[group_name] = [sid]
-        return []
-    other_members = group_calls[group_name]
-    result = other_members.copy()
-    other_members.append(sid)
-    return result
-
-
-def leave_group_call(sid, group_name):
-    members = group_calls.get(group_name)
-    if members:
-        if sid in members:
-            members.remove(sid)
-            if len(members) == 0:
-                del group_calls[group_name]
+    friends_online = []
+    for friend_id in user_data["friend_ids"]:
+        other_sid = call_user_sids.get(friend_id)
+        other_user = call_users.get(other_sid) if other_sid != sid else None
+        if other_user:
+            friends_online.append({"name": other_user["name"], "sid": other_sid})
+    return friends_online
 
 
 # def make_group_call_room(sid, username, signal, group_name):
@@ -127,30 +162,115 @@ def leave_group_call(sid, group_name):
 
 def remove_call_user(sid):
     try:
-        del call_users[sid]
+        user_id = call_users.pop(sid)["id"]
     except KeyError:
         return
+    registry.untrack(sid)
+    if call_user_sids.get(user_id) == sid:
+        del call_user_sids[user_id]
+
+
+@registry.on_stale_sid
+def forget_sid(sid):
+    remove_socket_user(sid)
+    remove_call_user(sid)
 
 
 def notify_chat(socketio, room_id):
-    for sid, user_id in socket_users.items():
-        if RoomRead.query.filter_by(user_id=user_id, room_id=room_id).first():
-            socketio.emit("notify_chat", room_id, room=sid)
+    for user_id in get_room_member_ids(room_id):
+        for sid in user_sids.members(user_id):
+            socketio.emit("notify_chat", room_id, room=sid, namespace="/chat")
 
 
 def modified_update(room=None, commit=False):
-    today = get_jkt_timezone().strftime("%Y-%m-%d %H:%M:%S:%f")
+    """Room lists are ordered by the room's modified_at, so a new message only
+    touches the room row and not every member's room_read row"""
+    today = datetime.utcnow()
     if room:
-        room.last_modified = today
-        for assoc in room.members:
-            assoc.last_modified = today
+        room.modified_at = today
         if commit:
             db.session.commit()
     return today
 
 
-def timestamp_get_datetime(timestamp):
-    return datetime.strptime(timestamp, "%b-%d %I:%M%p")
+def add_chat(chat_room, user, message, is_image=False):
+    chat = Chat(
+        message=message,
+        created_at=modified_update(chat_room),
+        user=user,
+        room=chat_room,
+        is_image=is_image,
+    )
+    db.session.add(chat)
+    db.session.flush()
+    # The sender has read the room up to their own message. Everyone else's
+    # unread count follows from last_read_id, so no other member row changes.
+    RoomRead.query.filter_by(user_id=user.id, room_id=chat_room.id).update(
+        {"is_read": True, "last_read_id": chat.id, "last_read_at": chat.created_at}
+    )
+    return chat
+
+
+def get_rooms_unread(user_id):
+    """Return (assoc, num_unread) for every room of the user in one query,
+    most recently active room first"""
+    return (
+        db.session.query(RoomRead, func.count(Chat.id))
+        .join(ChatRoom, ChatRoom.id == RoomRead.room_id)
+        .outerjoin(
+            Chat,
+            and_(
+                Chat.room_id == RoomRead.room_id,
+                Chat.id > RoomRead.last_read_id,
+                Chat.created_at.isnot(None),
+            ),
+        )
+        .filter(RoomRead.user_id == user_id)
+        .group_by(RoomRead.user_id, RoomRead.room_id, ChatRoom.modified_at)
+        .order_by(ChatRoom.modified_at.desc())
+        .all()
+    )
+
+
+def get_last_chat_id(room_id):
+    return (
+        db.session.query(func.coalesce(func.max(Chat.id), 0))
+        .filter(Chat.room_id == room_id)
+        .scalar()
+    )
+
+
+def mark_read(assoc):
+    assoc.is_read = True
+    assoc.last_read_at = datetime.utcnow()
+    assoc.last_read_id = get_last_chat_id(assoc.room_id)
+
+
+def get_chat_history(room_id, user_id, before_id=None, limit=CHAT_PAGE_SIZE):
+    """Return the newest ``limit`` chats older than ``before_id`` (oldest first)
+    and whether there are more to load"""
+    query = (
+        db.session.query(Chat, User.name)
+        .outerjoin(User, Chat.user_id == User.id)
+        .filter(Chat.room_id == room_id)
+    )
+    if before_id:
+        query = query.filter(Chat.id < before_id)
+    rows = query.order_by(Chat.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    chat_list = []
+    for chat, username in reversed(rows[:limit]):
+        chat_list.append(
+            {
+                "id": chat.id,
+                "msg": chat.message,
+                "time": format_timestamp(chat.created_at),
+                "is_user": chat.user_id == user_id,
+                "username": username,
+                "is_image": chat.is_image,
+            }
+        )
+    return chat_list, has_more
 
 
 def room_get_members(room):
@@ -158,7 +278,12 @@ def room_get_members(room):
 
 
 def user_get_rooms(user):
-    return [assoc.chat_room for assoc in user.chat_rooms]
+    return (
+        ChatRoom.query.join(RoomRead, RoomRead.room_id == ChatRoom.id)
+        .filter(RoomRead.user_id == user.id)
+        .order_by(ChatRoom.modified_at.desc())
+        .all()
+    )
 
 
 def get_timestamp():
@@ -167,6 +292,13 @@ def get_timestamp():
     return today.strftime("%b-%d %I:%M%p")
 
 
+def format_timestamp(time):
+    """Format a stored UTC datetime the way chat timestamps are sent to clients"""
+    if not time:
+        return None
+    return to_jkt_timezone(time).strftime("%b-%d %I:%M%p")
+
+
 def escape_input(msg):
     result = ""
     for char in msg:
@@ -184,10 +316,10 @@ def make_room_read(
     commit=False,
     name=False,
 ):
-    timestamp = get_timestamp()
     time = modified_update()
     if room and user:
-        a = RoomRead(last_modified=time, last_read=timestamp)
+        last_read_id = get_last_chat_id(room.id)
+        a = RoomRead(last_read_at=time, last_read_id=last_read_id)
         a.member = user
         a.chat_room = room
         if name:
@@ -197,8 +329,10 @@ def make_room_read(
                 if not assoc.member == user:
                     a.room_name = assoc.member.name
         db.session.add(a)
+        add_room_member(a)
     elif room_id and user_id:
-        a = RoomRead(last_modified=time, last_read=timestamp)
+        last_read_id = get_last_chat_id(room_id)
+        a = RoomRead(last_read_at=time, last_read_id=last_read_id)
         user = User.query.get(user_id)
         room = ChatRoom.query.get(room_id)
         a.member = user
@@ -210,9 +344,11 @@ def make_room_read(
                 (RoomRead.room_id == room_id and not RoomRead.user_id == user_id)
             ).member.name
         db.session.add(a)
+        add_room_member(a)
     elif room and users:
+        last_read_id = get_last_chat_id(room.id)
         for i in range(len(users)):
-            a = RoomRead(last_modified=time, last_read=timestamp)
+            a = RoomRead(last_read_at=time, last_read_id=last_read_id)
             a.member = users[i]
             a.chat_room = room
             if room.is_group:
@@ -223,39 +359,65 @@ def make_room_read(
                 else:
                     a.room_name = users[0].name
             db.session.add(a)
+            add_room_member(a)
     if commit:
         db.session.commit()
 
 
+def thumbnail_name(filename):
+    root, ext = os.path.splitext(filename)
+    return f"{root}-thumb{ext}"
+
+
 def delete_group_from_db(room, commit=False):
+    remove_room_members(room.id)
+    # Load the chats before the room delete is flushed, which unlinks them
+    chats = room.chats.all()
     assocs = room.members
     for assoc in assocs:
         db.session.delete(assoc)
     db.session.delete(room)
-    for chat in room.chats:
-        if chat.is_image:
-            filename = chat.message.split("/")[-1]
-            image = Image.query.filter_by(filename=filename).first()
-            if image:
-                db.session.delete(image)
+    # Image filenames are content hashes, so other rooms may post the same one
+    messages = {chat.message for chat in chats if chat.is_image}
+    if messages:
+        messages -= {
+            message
+            for message, in db.session.query(Chat.message).filter(
+                Chat.is_image,
+                Chat.message.in_(messages),
+                Chat.room_id != room.id,
+            )
+        }
+    digests = []
+    for message in messages:
+        filename = message.split("/")[-1]
+        filenames = [filename, thumbnail_name(filename)]
+        for image in Image.query.filter(Image.filename.in_(filenames)):
+            digests.append(image.digest)
+            db.session.delete(image)
+    for chat in chats:
         db.session.delete(chat)
     if commit:
         db.session.commit()
+        # Without commit the blobs stay on disk; they are only garbage then
+        release_blobs(digests)
 
 
-def JPEGSaveWithTargetSize(im, target):
-    """Save the image as JPEG with the given name at best quality that makes less than "target" bytes"""
-    Qmin, Qmax = 15, 50
+def JPEGSaveWithTargetSize(im, target, Qmin=15, Qmax=85):
+    """Return the image as JPEG bytes at the best quality that makes less than
+    "target" bytes (or at Qmin if nothing fits). Binary search, so at most
+    log2(Qmax - Qmin) + 1 encodes."""
     im = im.convert("RGB")
+    best = None
     while Qmin <= Qmax:
-        m = math.floor((Qmin + Qmax) / 2)
+        m = (Qmin + Qmax) // 2
         buffer = io.BytesIO()
-
-        im.save(buffer, format="JPEG", quality=m)
-        s = buffer.getbuffer().nbytes
-        print(s)
-        if s <= target:
-            break
-        elif s > target:
+        im.save(buffer, format="JPEG", quality=m, optimize=True)
+        if buffer.getbuffer().nbytes <= target:
+            best = buffer
+            Qmin = m + 1
+        else:
             Qmax = m - 1
-    return buffer.getvalue()
+    if best is None:
+        return buffer.getvalue()
+    return best.getvalue()
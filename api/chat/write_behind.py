@@ -0,0 +1,147 @@
+"""Optional write-behind mode for chat messages (``CHAT_WRITE_BEHIND=1``).
+
+Normally every message is inserted and committed before the handler
+returns, one transaction (and one fsync) per message. In write-behind mode
+``on_message`` and ``upload_image`` emit right away and queue the chat; a
+background flusher inserts the queued chats and updates their rooms in one
+transaction every ``CHAT_FLUSH_INTERVAL`` seconds, or sooner once
+``CHAT_FLUSH_SIZE`` chats are waiting. The queue is also flushed when the
+process exits.
+
+Guarantees:
+
+* Ordering: chats are inserted in the order this process received them, so
+  chat ids (and history order) follow arrival order per worker.
+* Durability: a message is delivered before it is committed. A crash or a
+  hard kill loses the queued messages, at most one interval or batch. A
+  failed flush puts its chats back at the head of the queue and is retried.
+  After ``CHAT_FLUSH_RETRIES`` failures in a row the batch is written one
+  chat per transaction instead, and the chats that still fail (a bad room
+  or user id, say) are logged and dropped so they can't block the queue.
+  With the database down for longer than that, every queued chat is lost.
+* Visibility: history, unread counts and read markers only see a message
+  after its batch is committed. The read and join handlers flush first so a
+  user never marks a room read behind a queued message.
+"""
+
+from collections import deque
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import and_, func, select
+from models import db, Chat, ChatRoom, RoomRead
+
+
+class ChatWriter:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 0.05
+        self.batch_size = 100
+        self.max_retries = 3
+        self.failures = 0
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config["CHAT_WRITE_BEHIND"]
+        self.interval = app.config["CHAT_FLUSH_INTERVAL"]
+        self.batch_size = app.config["CHAT_FLUSH_SIZE"]
+        self.max_retries = app.config["CHAT_FLUSH_RETRIES"]
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def add(self, room_id, user_id, message, is_image=False):
+        """Queue a chat, return its created_at"""
+        created_at = datetime.utcnow()
+        self.queue.append(
+            {
+                "room_id": room_id,
+                "user_id": user_id,
+                "message": message,
+                "is_image": is_image,
+                "created_at": created_at,
+            }
+        )
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.run, daemon=True)
+            self.flusher.start()
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+        return created_at
+
+    def flush(self):
+        """Write everything queued so far, one transaction per batch"""
+        # One flush at a time keeps batches committed in queue order
+        with self.lock:
+            while self.queue:
+                chats = []
+                while self.queue and len(chats) < self.batch_size:
+                    chats.append(self.queue.popleft())
+                try:
+                    self.write(chats)
+                except Exception:
+                    self.failures += 1
+                    if self.failures < self.max_retries:
+                        self.queue.extendleft(reversed(chats))
+                        raise
+                    self.write_each(chats)
+                self.failures = 0
+
+    def write_each(self, chats):
+        """Write a batch that keeps failing one chat at a time, dropping the
+        chats that fail on their own"""
+        for chat in chats:
+            try:
+                self.write([chat])
+            except Exception as e:
+                print("Dropped a queued chat that could not be written:", chat, e)
+
+    def write(self, chats):
+        # Newest chat of each room, and the rooms each sender wrote to
+        rooms = {chat["room_id"]: chat for chat in chats}
+        senders = {(chat["room_id"], chat["user_id"]): chat for chat in chats}
+        with self.app.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(Chat.__table__.insert(), chats)
+                for room_id, chat in rooms.items():
+                    conn.execute(
+                        ChatRoom.__table__.update()
+                        .where(ChatRoom.id == room_id)
+                        .values(modified_at=chat["created_at"])
+                    )
+                # Same as util.add_chat: senders have read up to their message
+                for (room_id, user_id), chat in senders.items():
+                    last_id = (
+                        select([func.max(Chat.id)])
+                        .where(and_(Chat.room_id == room_id, Chat.user_id == user_id))
+                        .as_scalar()
+                    )
+                    conn.execute(
+                        RoomRead.__table__.update()
+                        .where(
+                            and_(
+                                RoomRead.room_id == room_id, RoomRead.user_id == user_id
+                            )
+                        )
+                        .values(
+                            is_read=True,
+                            last_read_id=last_id,
+                            last_read_at=chat["created_at"],
+                        )
+                    )
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Failed to write queued chats:", e)
+
+
+chat_writer = ChatWriter()
@@ -1,23 +1,59 @@
-from flask import Flask, Blueprint
+from flask import Flask
+from flask.cli import with_appcontext
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
-from config import BaseConfig
-from models import db, User
+from config import BaseConfig, resolve_config
+from models import db
 from api import api
-from api.chat import socketio
+from api.chat import socketio, message_queue
+from api.chat.registry import registry
+from api.chat.group_calls import group_calls
+from api.chat.write_behind import chat_writer
+from util.blob_store import blob_store
+from util.identity import load_user
+from util.view_counter import view_counter
+from util.engine import describe_engine, patch_psycopg
+import click
 import wtforms_json
 
-app = Flask(__name__)
-jwt = JWTManager(app)
-app.config.from_object(BaseConfig)
-app.register_blueprint(api, url_prefix="/api")
-db.init_app(app)
-cors = CORS(app)
-socketio.init_app(app)
+jwt = JWTManager()
+cors = CORS()
 wtforms_json.init()
 
-with app.app_context():
+
+def create_app(config=BaseConfig):
+    """Build the app. Nothing here opens the database, so the app can be
+    created in the gunicorn master (``--preload``) and forked into workers.
+    The schema is created by ``flask create-db``."""
+    app = Flask(__name__)
+    app.config.from_object(config)
+    resolve_config(app.config)
+    jwt.init_app(app)
+    app.register_blueprint(api, url_prefix="/api")
+    db.init_app(app)
+    cors.init_app(app)
+    socketio.init_app(
+        app, **message_queue.get_options(app.config["SOCKETIO_MESSAGE_QUEUE"])
+    )
+    registry.init_app(app)
+    group_calls.init_app(app)
+    chat_writer.init_app(app)
+    blob_store.init_app(app)
+    view_counter.init_app(app)
+    patch_psycopg()
+    app.cli.add_command(create_db)
+    return app
+
+
+@click.command("create-db")
+@with_appcontext
+def create_db():
+    """Create missing tables, then apply pending migrations"""
+    from migrate import upgrade
+
     db.create_all()
+    upgrade()
+    click.echo(describe_engine(db.engine))
 
 
 @jwt.user_identity_loader
@@ -28,8 +64,11 @@ def user_identity_lookup(user):
 @jwt.user_lookup_loader
 def user_lookup_callback(_jwt_header, jwt_data):
     identity = jwt_data["sub"]
-    return User.query.filter_by(id=identity).one_or_none()
+    return load_user(identity)
 
 
 if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        print(describe_engine(db.engine))
     socketio.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,209 @@
+"""Synthetic data for benchmarks and load tests.
+
+    python -m bench.data [--scale small|medium|large]
+
+Fills the configured database (DATABASE_URL) with users, friendships, posts,
+comments, group and direct chat rooms and their chats. Rows are bulk
+inserted, so even the large scale takes seconds. Every user's password is
+``BENCH_PASSWORD``. Room 1 is the "general" group every user belongs to,
+like on the live site.
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta
+from models import (
+    db,
+    User,
+    BlogPost,
+    Comment,
+    ChatRoom,
+    RoomRead,
+    Chat,
+    user_friends,
+)
+from util.passwords import hash_password
+
+BENCH_PASSWORD = "benchmark-password"
+
+SCALES = {
+    "small": dict(
+        users=50,
+        friends=5,
+        posts=100,
+        comments=5,
+        groups=5,
+        members=10,
+        dms=20,
+        chats=200,
+    ),
+    "medium": dict(
+        users=500,
+        friends=10,
+        posts=1000,
+        comments=10,
+        groups=50,
+        members=50,
+        dms=200,
+        chats=1000,
+    ),
+    "large": dict(
+        users=5000,
+        friends=20,
+        posts=5000,
+        comments=20,
+        groups=200,
+        members=200,
+        dms=2000,
+        chats=5000,
+    ),
+}
+
+WORDS = (
+    "flask socket python gevent server blog chat room post comment image "
+    "query index cache latency worker thread database message friend call"
+).split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def insert(table, rows, batch_size=5000):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start : start + batch_size])
+
+
+def generate(users, friends, posts, comments, groups, members, dms, chats, seed=0):
+    """Fill the database, return the ids of the created users, posts and
+    rooms. Needs an app context and an empty database."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    password = hash_password(BENCH_PASSWORD)
+    insert(
+        User.__table__,
+        [
+            {
+                "id": id,
+                "email": f"user{id}@example.com",
+                "password": password,
+                "name": f"user{id}",
+                "is_online": False,
+            }
+            for id in range(1, users + 1)
+        ],
+    )
+    user_ids = list(range(1, users + 1))
+    friend_rows = set()
+    for user_id in user_ids:
+        for friend_id in rng.sample(user_ids, min(friends, users)):
+            if friend_id != user_id:
+                friend_rows.add((user_id, friend_id))
+                friend_rows.add((friend_id, user_id))
+    insert(
+        user_friends,
+        [
+            {"user_id": user_id, "friend_id": friend_id}
+            for user_id, friend_id in friend_rows
+        ],
+    )
+
+    insert(
+        BlogPost.__table__,
+        [
+            {
+                "id": id,
+                "author_id": 1,
+                "title": sentence(rng, 6).capitalize(),
+                "subtitle": sentence(rng, 10),
+                "date": (now - timedelta(days=posts - id)).strftime("%B %d, %Y"),
+                "body": "<p>" + sentence(rng, 400) + "</p>",
+                "img_url": f"https://picsum.photos/seed/{id}/1200/600",
+                "views": rng.randrange(1000),
+                "hidden": rng.random() < 0.05,
+            }
+            for id in range(1, posts + 1)
+        ],
+    )
+    post_ids = list(range(2, posts + 1))
+    insert(
+        Comment.__table__,
+        [
+            {
+                "author_id": rng.choice(user_ids),
+                "post_id": post_id,
+                "text": sentence(rng, 20),
+            }
+            for post_id in post_ids
+            for _ in range(comments)
+        ],
+    )
+
+    # Room 1 holds everyone, then the other groups, then direct messages
+    rooms = [(1, "general", user_ids)]
+    for index in range(groups):
+        rooms.append(
+            (len(rooms) + 1, f"group{index}", rng.sample(user_ids, min(members, users)))
+        )
+    for _ in range(dms):
+        rooms.append((len(rooms) + 1, None, rng.sample(user_ids, 2)))
+    insert(
+        ChatRoom.__table__,
+        [
+            {"id": id, "name": name, "is_group": name is not None, "modified_at": now}
+            for id, name, _ in rooms
+        ],
+    )
+    room_reads = []
+    chat_rows = []
+    for room_id, name, room_user_ids in rooms:
+        for user_id in room_user_ids:
+            if name is None:
+                other = [id for id in room_user_ids if id != user_id][0]
+                room_name = f"user{other}"
+            else:
+                room_name = name
+            room_reads.append(
+                {
+                    "user_id": user_id,
+                    "room_id": room_id,
+                    "room_name": room_name,
+                    "is_read": True,
+                    "last_read_id": 0,
+                    "last_read_at": now,
+                }
+            )
+        count = chats if name is not None else max(1, chats // 10)
+        for index in range(count):
+            chat_rows.append(
+                {
+                    "room_id": room_id,
+                    "user_id": rng.choice(room_user_ids),
+                    "message": sentence(rng, 12),
+                    "is_image": False,
+                    "created_at": now - timedelta(minutes=count - index),
+                }
+            )
+    insert(RoomRead.__table__, room_reads)
+    insert(Chat.__table__, chat_rows)
+    db.session.commit()
+    return {
+        "user_ids": user_ids,
+        "post_ids": post_ids,
+        "room_ids": [room_id for room_id, _, _ in rooms],
+        "rooms": {room_id: room_user_ids for room_id, _, room_user_ids in rooms},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    from app import create_app
+    from models import db
+
+    with create_app().app_context():
+        db.create_all()
+        generate(seed=args.seed, **SCALES[args.scale])
+    print(f"Generated the {args.scale} dataset")
@@ -0,0 +1,308 @@
+"""Local load test for the REST API and the socket.io namespaces.
+
+    python -m bench.load [--scale small] [--clients 8] [--requests 50]
+                         [--scenarios login,post,...] [--save-baseline]
+                         [--compare] [--threshold 0.25]
+
+Builds a temporary SQLite database with bench.data, then runs every
+scenario with ``--clients`` simulated clients in parallel threads, each
+doing ``--requests`` operations through the Flask and Flask-SocketIO test
+clients. Reports p50/p95/p99 latency and operations (for the chat message
+scenario: messages) per second.
+
+``--save-baseline`` writes the results to bench/baseline.json (the numbers
+only mean something on the machine that made them, so it is not committed).
+``--compare`` exits with status 1 when a scenario's p95 is more than
+``--threshold`` slower, or its throughput that much lower, than the baseline.
+"""
+
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Doesn't import the app, its config is read once setup() has set the env
+from bench.data import SCALES
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+class Client:
+    """One simulated user with an HTTP client and lazily opened sockets"""
+
+    def __init__(self, app, socketio, data, user_id, token, seed):
+        self.app = app
+        self.socketio = socketio
+        self.data = data
+        self.user_id = user_id
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.rng = random.Random(seed)
+        self.http = app.test_client()
+        self.rooms = [
+            room_id for room_id, members in data["rooms"].items() if user_id in members
+        ]
+        self.sockets = {}
+
+    def socket(self, namespace):
+        if namespace not in self.sockets:
+            self.sockets[namespace] = self.socketio.test_client(
+                self.app, namespace=namespace, headers=self.headers
+            )
+            self.sockets[namespace].get_received(namespace)
+        return self.sockets[namespace]
+
+    def sid(self, namespace):
+        socket = self.socket(namespace)
+        return self.socketio.server.manager.sid_from_eio_sid(socket.eio_sid, namespace)
+
+    def close(self):
+        for namespace, socket in self.sockets.items():
+            if socket.is_connected(namespace):
+                socket.disconnect(namespace=namespace)
+
+
+def scenario_login(client):
+    from bench.data import BENCH_PASSWORD
+
+    response = client.http.post(
+        "/api/auth/login",
+        json={"email": f"user{client.user_id}@example.com", "password": BENCH_PASSWORD},
+    )
+    assert response.status_code == 200, response.status_code
+
+
+def scenario_home_posts(client):
+    cursor = client.rng.choice([None] + client.data["post_ids"])
+    url = "/api/home/posts" + (f"?cursor={cursor}" if cursor else "")
+    response = client.http.get(url, headers=client.headers)
+    assert response.status_code == 200, response.status_code
+
+
+def scenario_post(client):
+    post_id = client.rng.choice(client.data["post_ids"])
+    response = client.http.get(f"/api/post?id={post_id}", headers=client.headers)
+    assert response.status_code in (200, 404), response.status_code
+
+
+def scenario_post_comments(client):
+    post_id = client.rng.choice(client.data["post_ids"])
+    response = client.http.get(
+        f"/api/post/comment?id={post_id}", headers=client.headers
+    )
+    assert response.status_code in (200, 404), response.status_code
+
+
+def scenario_chat_connect(client):
+    socket = client.socketio.test_client(
+        client.app, namespace="/chat", headers=client.headers
+    )
+    assert socket.is_connected("/chat")
+    socket.disconnect(namespace="/chat")
+
+
+def scenario_chat_join(client):
+    socket = client.socket("/chat")
+    socket.emit("join", {"room_id": client.rng.choice(client.rooms)}, namespace="/chat")
+    socket.get_received("/chat")
+
+
+def scenario_chat_message(client):
+    socket = client.socket("/chat")
+    room_id = client.rng.choice(client.rooms)
+    socket.emit(
+        "message",
+        {"msg": "load test message", "room": {"room_id": room_id}},
+        namespace="/chat",
+    )
+    socket.get_received("/chat")
+
+
+def scenario_call_signal(client):
+    socket = client.socket("/call")
+    sid = client.sid("/call")
+    socket.emit(
+        "call_user", {"user_to_call": sid, "signal": "offer"}, namespace="/call"
+    )
+    socket.emit("answer_call", {"to": sid, "signal": "answer"}, namespace="/call")
+    socket.get_received("/call")
+
+
+def scenario_groupcall(client):
+    socket = client.socket("/groupcall")
+    group = f"bench-{client.user_id % 4}"
+    socket.emit("join_room", group, namespace="/groupcall")
+    socket.emit(
+        "sending_signal",
+        {"user_to_signal": client.sid("/groupcall"), "signal": "offer"},
+        namespace="/groupcall",
+    )
+    socket.emit("leave_room", group, namespace="/groupcall")
+    socket.get_received("/groupcall")
+
+
+SCENARIOS = {
+    "login": scenario_login,
+    "home_posts": scenario_home_posts,
+    "post": scenario_post,
+    "post_comments": scenario_post_comments,
+    "chat_connect": scenario_chat_connect,
+    "chat_join": scenario_chat_join,
+    "chat_message": scenario_chat_message,
+    "call_signal": scenario_call_signal,
+    "groupcall": scenario_groupcall,
+}
+
+
+def run_scenario(scenario, clients, requests):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def run_client(client):
+        own = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            try:
+                scenario(client)
+            except Exception as e:
+                errors.append(e)
+                continue
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(clients)) as executor:
+        list(executor.map(run_client, clients))
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        raise RuntimeError(f"Every operation failed: {errors[0]!r}")
+    return {
+        "ops": len(latencies),
+        "errors": len(errors),
+        "ops_per_sec": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return the lines describing regressions against the baseline"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if not before:
+            continue
+        if result["p95"] > before["p95"] * (1 + threshold):
+            regressions.append(
+                f"{name}: p95 {result['p95']:.2f}ms, baseline {before['p95']:.2f}ms"
+            )
+        if result["ops_per_sec"] < before["ops_per_sec"] * (1 - threshold):
+            regressions.append(
+                f"{name}: {result['ops_per_sec']:.0f} ops/s, "
+                f"baseline {before['ops_per_sec']:.0f} ops/s"
+            )
+    return regressions
+
+
+def setup(scale):
+    """Point the app at a temporary database and blob store, fill it and
+    return the app, socketio and dataset"""
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    # Registered before the app's own exit handlers, so it runs after them
+    atexit.register(shutil.rmtree, tmp, True)
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "bench.db")
+    os.environ["BLOB_STORE_PATH"] = os.path.join(tmp, "blobs")
+    os.environ["PRESENCE_REGISTRY_URL"] = "memory://"
+    os.environ.pop("SOCKETIO_MESSAGE_QUEUE", None)
+
+    from app import create_app
+    from api.chat import socketio
+    from bench.data import generate
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        data = generate(**SCALES[scale])
+    return app, socketio, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    app, socketio, data = setup(args.scale)
+    from flask_jwt_extended import create_access_token
+    from models import User
+
+    with app.app_context():
+        clients = []
+        for index in range(args.clients):
+            # Users 1 and 2 are admins, simulate regular readers
+            user_id = data["user_ids"][(index + 2) % len(data["user_ids"])]
+            token = create_access_token(identity=User.query.get(user_id))
+            clients.append(Client(app, socketio, data, user_id, token, index))
+
+    results = {}
+    print(
+        f"{'scenario':<16}{'ops':>7}{'err':>5}{'ops/s':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    for name in args.scenarios.split(","):
+        # The handlers print progress, keep it out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run_scenario(SCENARIOS[name], clients, args.requests)
+        results[name] = result
+        print(
+            f"{name:<16}{result['ops']:>7}{result['errors']:>5}"
+            f"{result['ops_per_sec']:>10.1f}{result['p50']:>10.2f}"
+            f"{result['p95']:>10.2f}{result['p99']:>10.2f}"
+        )
+    with contextlib.redirect_stdout(io.StringIO()):
+        for client in clients:
+            client.close()
+
+    settings = {"scale": args.scale, "clients": args.clients, "requests": args.requests}
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"settings": settings, "results": results}, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline["settings"] != settings:
+            print(f"Baseline was made with {baseline['settings']}, not {settings}")
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("Regression:", line)
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare util.row2dict with the precompiled serializers.
+
+    python -m bench.serializers [--number N]
+
+Builds detached post and user rows like the ones the API serves and times
+turning them into dicts, and into JSON with the stdlib encoder and orjson.
+"""
+
+import argparse
+import json
+import timeit
+from models import BlogPost, User
+from util import row2dict
+from util.serializers import get_serializer, orjson
+
+
+def make_row(model, **values):
+    # Skip the model constructors, User.__init__ hashes the password
+    row = model.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        setattr(row, key, value)
+    return row
+
+
+def make_rows():
+    post = make_row(
+        BlogPost,
+        id=42,
+        author_id=1,
+        title="Setting up a home server on a budget",
+        subtitle="What worked, what did not and what it cost",
+        date="June 20, 2021",
+        body="<p>"
+        + "Lorem ipsum dolor sit amet, consectetur adipiscing. " * 100
+        + "</p>",
+        img_url="https://images.unsplash.com/photo-1519681393784-d120267933ba",
+        views=1234,
+        hidden=False,
+    )
+    user = make_row(
+        User,
+        id=7,
+        email="someone@example.com",
+        password="pbkdf2:sha256:260000$" + "x" * 80,
+        name="Someone",
+        is_online=True,
+    )
+    return [
+        ("post", post, ("hidden",)),
+        ("post summary", post, ("hidden", "author_id", "body", "img_url")),
+        ("user", user, ("password", "is_online")),
+    ]
+
+
+def run(number):
+    print(f"{'case':<34}{'usec/row':>10}")
+    for name, row, exclude in make_rows():
+        serialize = get_serializer(type(row), exclude)
+        cases = [
+            ("row2dict", lambda: row2dict(row, list(exclude))),
+            ("serializer", lambda: serialize(row)),
+            ("row2dict + json", lambda: json.dumps(row2dict(row, list(exclude)))),
+            ("serializer + json", lambda: json.dumps(serialize(row))),
+        ]
+        if orjson is not None:
+            cases.append(("serializer + orjson", lambda: orjson.dumps(serialize(row))))
+        for case, fn in cases:
+            seconds = min(timeit.repeat(fn, number=number, repeat=5))
+            print(f"{name + ': ' + case:<34}{seconds / number * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    run(parser.parse_args().number)
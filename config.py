@@ -1,10 +1,12 @@
+import os
+from util.engine import get_engine_options
+
+
 class BaseConfig:
     # Statement for enabling the development environment
     DEBUG = False
 
     # Define the application directory
-    import os
-
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
     # Define the database - we are working with
@@ -13,12 +15,26 @@ class BaseConfig:
         "DATABASE_URL", "sqlite:///" + os.path.join(BASE_DIR, "blog.db")
     )
 
-    if os.path.exists("db.txt"):
-        with open("db.txt", "r") as file:
-            SQLALCHEMY_DATABASE_URI = file.read()
+    # A file holding the database URI overrides it, read by resolve_config
+    DATABASE_URI_FILE = "db.txt"
 
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
-    DATABASE_CONNECT_OPTIONS = {}
+    # Pool and connection settings for the backend, see util/engine.py. Left
+    # unset, they are picked from the URI by resolve_config.
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    SQLALCHEMY_ENGINE_OPTIONS = None
+
+    # Uploaded images and files are stored here, see util/blob_store.py
+    BLOB_STORE_PATH = os.environ.get("BLOB_STORE_PATH", os.path.join(BASE_DIR, "blobs"))
+    # Let a front server (nginx X-Accel / Apache X-Sendfile) send blob files
+    USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE") == "1"
+    # Seconds between writes of buffered post views, see util/view_counter.py
+    VIEW_FLUSH_INTERVAL = float(os.environ.get("VIEW_FLUSH_INTERVAL", 5))
+    # Seconds a cached blog response is kept at most, see api.cached_response
+    RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 300))
+
+    # Nothing listens to Flask-SQLAlchemy's model change signals
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     # Enable protection agains *Cross-site Request Forgery (CSRF)*
     CSRF_ENABLED = True
@@ -36,4 +52,45 @@ class BaseConfig:
 
     CORS_HEADERS = "Content-Type"
 
+    # Changing the work factor upgrades stored hashes on the next login
+    PASSWORD_HASH_METHOD = os.environ.get(
+        "PASSWORD_HASH_METHOD", "pbkdf2:sha256:260000"
+    )
+
+    # Shared state for running more than one worker: the presence registry
+    # (memory://, sqlite:///path or redis://...) and the socket.io message
+    # queue used for cross-process emits (unset for a single worker)
+    PRESENCE_REGISTRY_URL = os.environ.get("PRESENCE_REGISTRY_URL", "memory://")
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+    # Seconds without a heartbeat before a worker's sids are dropped from the
+    # registry, see api/chat/registry.py
+    PRESENCE_WORKER_TTL = float(os.environ.get("PRESENCE_WORKER_TTL", 30))
+
+    # Queue chat messages and commit them in batches, see
+    # api/chat/write_behind.py for what this trades away
+    CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND") == "1"
+    CHAT_FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL", 0.05))
+    CHAT_FLUSH_SIZE = int(os.environ.get("CHAT_FLUSH_SIZE", 100))
+    CHAT_FLUSH_RETRIES = int(os.environ.get("CHAT_FLUSH_RETRIES", 3))
+
+    # Group call room size and how long a sid may go unseen before it is
+    # reaped, see api/chat/group_calls.py
+    GROUP_CALL_MAX_MEMBERS = int(os.environ.get("GROUP_CALL_MAX_MEMBERS", 8))
+    GROUP_CALL_TTL = float(os.environ.get("GROUP_CALL_TTL", 60))
+
     WTF_CSRF_ENABLED = False
+
+
+def resolve_config(config):
+    """Fill in the settings that depend on files or on other settings. Called
+    once by create_app, so importing this module does no I/O."""
+    path = config.get("DATABASE_URI_FILE")
+    if path and os.path.exists(path):
+        with open(path, "r") as file:
+            config["SQLALCHEMY_DATABASE_URI"] = file.read().strip()
+    if config.get("SQLALCHEMY_ENGINE_OPTIONS") is None:
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(
+            config["SQLALCHEMY_DATABASE_URI"],
+            config["DB_POOL_SIZE"],
+            config["DB_MAX_OVERFLOW"],
+        )
@@ -0,0 +1,43 @@
+"""Gunicorn settings, read from the working directory.
+
+The app is created once in the master (preload_app) and forked into the
+worker. gevent has to patch the standard library before the app is
+imported, since its modules create locks and thread-locals at import.
+
+Gunicorn has no sticky sessions, and socket.io clients start on HTTP
+long-polling, so a handshake and the polls after it must reach the same
+worker. That makes one worker per gunicorn a hard limit: WEB_CONCURRENCY is
+ignored and -w above 1 fails at startup. Scaling out means running more of
+these processes (or dynos) behind a load balancer with session affinity, with
+PRESENCE_REGISTRY_URL and SOCKETIO_MESSAGE_QUEUE pointing at shared backends,
+see api/chat/registry.py.
+"""
+
+from gevent import monkey
+
+monkey.patch_all()
+
+worker_class = "geventwebsocket.gunicorn.workers.GeventWebSocketWorker"
+workers = 1
+preload_app = True
+
+
+def on_starting(server):
+    if server.cfg.workers > 1:
+        raise RuntimeError(
+            "Socket.IO needs one worker per gunicorn process, run more processes "
+            "behind a load balancer with session affinity instead"
+        )
+
+
+def post_worker_init(worker):
+    from api.chat.group_calls import group_calls
+    from api.chat.registry import registry
+    from models import db
+    from util.engine import describe_engine
+
+    registry.start()
+    group_calls.start()
+
+    with worker.wsgi.app_context():
+        print(describe_engine(db.engine))
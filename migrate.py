@@ -0,0 +1,294 @@
+"""Versioned schema migrations.
+
+``db.create_all`` only creates missing tables, so changes to existing tables
+(new columns, indexes, data conversions) live here as numbered migrations.
+Applied versions are recorded in the schema_migrations table and each
+migration runs in its own transaction. Run at deploy time with::
+
+    flask create-db
+
+which creates missing tables first (``python migrate.py`` does the same).
+
+Migrations run against whatever schema the database has, so they use plain
+SQL on the tables instead of the current models. They also have to be no-ops
+on a database freshly built by ``db.create_all``.
+"""
+
+from datetime import datetime, timedelta
+from sqlalchemy import inspect
+from models import db
+
+JKT_OFFSET = timedelta(hours=7)
+
+
+def get_columns(conn, table):
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+
+def add_column(conn, table, name, type_, default=None):
+    type_name = type_.compile(dialect=conn.dialect)
+    sql = f"ALTER TABLE {table} ADD COLUMN {name} {type_name}"
+    if default is not None:
+        sql += f" DEFAULT {default}"
+    conn.execute(sql)
+
+
+def parse_chat_timestamp(timestamp, year):
+    """Old chat timestamps look like "Jun-20 01:05PM" (Jakarta time, no year)"""
+    return datetime.strptime(f"{year}-{timestamp}", "%Y-%b-%d %I:%M%p")
+
+
+def add_room_read_last_read_id(conn):
+    """Unread counters compare chat ids, so remember the last chat each member
+    read. Filled in by convert_chat_timestamps, the old timestamps have no
+    year and can't be compared before they are converted."""
+    if "last_read_id" in get_columns(conn, "room_read"):
+        return
+    add_column(conn, "room_read", "last_read_id", db.Integer(), default=0)
+
+
+# The newest chat of the room sent by last_read_at. Members that never read
+# the room and chats without a timestamp count as read, as they did before.
+LAST_READ_ID = """
+    COALESCE((
+        SELECT MAX(chats.id) FROM chats
+        WHERE chats.room_id = room_read.room_id
+        AND (
+            room_read.last_read_at IS NULL
+            OR chats.created_at IS NULL
+            OR chats.created_at <= room_read.last_read_at
+        )
+    ), 0)
+"""
+
+
+def convert_chat_timestamps(conn):
+    """Store chats.time and room_read.last_read as UTC datetimes.
+
+    The old strings have no year. Chats are walked from the newest back,
+    starting in the current year and stepping back a year whenever a message
+    looks newer than the one sent after it. room_read.last_read_id is filled
+    in from the converted times."""
+    if "created_at" in get_columns(conn, "chats"):
+        return
+    add_column(conn, "chats", "created_at", db.DateTime())
+    now = datetime.utcnow() + JKT_OFFSET
+    rows = conn.execute(
+        "SELECT id, time FROM chats WHERE time IS NOT NULL ORDER BY id DESC"
+    ).fetchall()
+    year = now.year
+    newer = now
+    values = []
+    for chat_id, time in rows:
+        created_at = parse_chat_timestamp(time, year)
+        while created_at > newer:
+            year -= 1
+            created_at = parse_chat_timestamp(time, year)
+        newer = created_at
+        values.append({"id": chat_id, "created_at": created_at - JKT_OFFSET})
+    if values:
+        conn.execute(
+            db.text(
+                "UPDATE chats SET created_at = :created_at WHERE id = :id"
+            ).bindparams(db.bindparam("created_at", type_=db.DateTime)),
+            values,
+        )
+
+    add_column(conn, "room_read", "last_read_at", db.DateTime())
+    values = []
+    for user_id, room_id, last_read in conn.execute(
+        "SELECT user_id, room_id, last_read FROM room_read WHERE last_read IS NOT NULL"
+    ).fetchall():
+        last_read_at = parse_chat_timestamp(last_read, now.year)
+        if last_read_at > now:
+            last_read_at = parse_chat_timestamp(last_read, now.year - 1)
+        values.append(
+            {
+                "user_id": user_id,
+                "room_id": room_id,
+                "last_read_at": last_read_at - JKT_OFFSET,
+            }
+        )
+    if values:
+        conn.execute(
+            db.text(
+                "UPDATE room_read SET last_read_at = :last_read_at "
+                "WHERE user_id = :user_id AND room_id = :room_id"
+            ).bindparams(db.bindparam("last_read_at", type_=db.DateTime)),
+            values,
+        )
+    conn.execute(f"UPDATE room_read SET last_read_id = {LAST_READ_ID}")
+
+
+def convert_modified_timestamps(conn):
+    """last_modified was a "%Y-%m-%d %H:%M:%S:%f" Jakarta time string"""
+    for table, keys in (("chat_rooms", ["id"]), ("room_read", ["user_id", "room_id"])):
+        columns = get_columns(conn, table)
+        # room_read.modified_at is gone from fresh databases, see migration 8
+        if "modified_at" in columns or "last_modified" not in columns:
+            continue
+        add_column(conn, table, "modified_at", db.DateTime())
+        values = []
+        for row in conn.execute(
+            f"SELECT {', '.join(keys)}, last_modified FROM {table} "
+            "WHERE last_modified IS NOT NULL"
+        ).fetchall():
+            modified_at = datetime.strptime(row[-1], "%Y-%m-%d %H:%M:%S:%f")
+            value = dict(zip(keys, row))
+            value["modified_at"] = modified_at - JKT_OFFSET
+            values.append(value)
+        if values:
+            where = " AND ".join(f"{key} = :{key}" for key in keys)
+            conn.execute(
+                db.text(
+                    f"UPDATE {table} SET modified_at = :modified_at WHERE {where}"
+                ).bindparams(db.bindparam("modified_at", type_=db.DateTime)),
+                values,
+            )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_chats_created_at ON chats (created_at)")
+    if "modified_at" in get_columns(conn, "room_read"):
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_room_read_modified_at "
+            "ON room_read (modified_at)"
+        )
+
+
+def add_hot_path_indexes(conn):
+    """Indexes for the login, chat history, room list, comment and friend lookups"""
+    duplicates = conn.execute(
+        "SELECT email FROM users GROUP BY email HAVING COUNT(*) > 1"
+    ).fetchall()
+    if duplicates:
+        emails = ", ".join(email for email, in duplicates)
+        raise RuntimeError(f"Cannot add unique index on users.email: {emails}")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_chats_room_id_id ON chats (room_id, id)"
+    )
+    conn.execute("DROP INDEX IF EXISTS ix_room_read_modified_at")
+    if "modified_at" in get_columns(conn, "room_read"):
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_room_read_user_id_modified_at "
+            "ON room_read (user_id, modified_at)"
+        )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_comments_post_id_id ON comments (post_id, id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_friends_user_id_friend_id "
+        "ON friends (user_id, friend_id)"
+    )
+
+
+def move_blobs_to_store(conn):
+    """Move images.img and file.file out of the database into the blob store"""
+    from util.blob_store import blob_store
+
+    for table, column in (("images", "img"), ("file", "file")):
+        if "digest" in get_columns(conn, table):
+            continue
+        add_column(conn, table, "digest", db.String(64))
+        add_column(conn, table, "size", db.Integer())
+        ids = [id for id, in conn.execute(f"SELECT id FROM {table}").fetchall()]
+        for id in ids:
+            data = conn.execute(
+                db.text(f"SELECT {column} FROM {table} WHERE id = :id"), id=id
+            ).scalar()
+            digest, size = blob_store.put(data)
+            conn.execute(
+                db.text(
+                    f"UPDATE {table} SET digest = :digest, size = :size WHERE id = :id"
+                ),
+                digest=digest,
+                size=size,
+                id=id,
+            )
+        conn.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS ix_{table}_digest ON {table} (digest)"
+        )
+
+
+def drop_room_read_modified_index(conn):
+    """Room lists are ordered by chat_rooms.modified_at now, the primary key
+    covers looking up a user's room_read rows"""
+    conn.execute("DROP INDEX IF EXISTS ix_room_read_user_id_modified_at")
+
+
+def add_search_index(conn):
+    """Full-text index over posts and chats, see util/search.py"""
+    from util.search import create_index
+
+    create_index(conn)
+
+
+def drop_room_read_modified_at(conn):
+    """room_read.modified_at has not been written since rooms are ordered by
+    chat_rooms.modified_at"""
+    if "modified_at" not in get_columns(conn, "room_read"):
+        return
+    conn.execute("DROP INDEX IF EXISTS ix_room_read_modified_at")
+    conn.execute("DROP INDEX IF EXISTS ix_room_read_user_id_modified_at")
+    conn.execute("ALTER TABLE room_read DROP COLUMN modified_at")
+
+
+def repair_room_read_last_read_id(conn):
+    """Migration 1 used to compare the old timestamps within the current year,
+    so histories spanning a new year came out almost all unread. Raise
+    last_read_id to what last_read_at says; never lower it, members may have
+    read on since."""
+    conn.execute(
+        f"UPDATE room_read SET last_read_id = {LAST_READ_ID} "
+        f"WHERE last_read_at IS NOT NULL AND {LAST_READ_ID} > last_read_id"
+    )
+
+
+MIGRATIONS = [
+    (1, add_room_read_last_read_id),
+    (2, convert_chat_timestamps),
+    (3, convert_modified_timestamps),
+    (4, add_hot_path_indexes),
+    (5, move_blobs_to_store),
+    (6, drop_room_read_modified_index),
+    (7, add_search_index),
+    (8, drop_room_read_modified_at),
+    (9, repair_room_read_last_read_id),
+]
+
+
+def get_applied_versions(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations "
+        "(version INTEGER PRIMARY KEY, name VARCHAR(100), applied_at VARCHAR(50))"
+    )
+    return {
+        version for version, in conn.execute("SELECT version FROM schema_migrations")
+    }
+
+
+def upgrade():
+    with db.engine.begin() as conn:
+        applied = get_applied_versions(conn)
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as conn:
+            migration(conn)
+            conn.execute(
+                db.text(
+                    "INSERT INTO schema_migrations (version, name, applied_at) "
+                    "VALUES (:version, :name, :applied_at)"
+                ),
+                version=version,
+                name=migration.__name__,
+                applied_at=str(datetime.utcnow()),
+            )
+        print(f"Applied migration {version} {migration.__name__}")
+
+
+if __name__ == "__main__":
+    from app import create_app
+
+    with create_app().app_context():
+        db.create_all()
+        upgrade()
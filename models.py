@@ -1,6 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship
-from werkzeug.security import generate_password_hash, check_password_hash
+from util.passwords import hash_password, check_password, needs_rehash
 
 db = SQLAlchemy()
 
@@ -8,13 +8,14 @@ user_friends = db.Table(
     "friends",
     db.Column("user_id", db.Integer, db.ForeignKey("users.id")),
     db.Column("friend_id", db.Integer, db.ForeignKey("users.id")),
+    db.Index("ix_friends_user_id_friend_id", "user_id", "friend_id"),
 )
 
 
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(100))
+    email = db.Column(db.String(100), unique=True, index=True)
     password = db.Column(db.String(100))
     name = db.Column(db.String(100))
     is_online = db.Column(db.Boolean, default=True)
@@ -23,9 +24,8 @@ class User(db.Model):
     comments = relationship("Comment", back_populates="comment_author")
     files = relationship("File", back_populates="file_owner")
     chats = relationship("Chat", back_populates="user")
-    chat_rooms = relationship(
-        "RoomRead", back_populates="member", order_by="RoomRead.last_modified.desc()"
-    )
+    # Unordered, see util.user_get_rooms for the rooms by last activity
+    chat_rooms = relationship("RoomRead", back_populates="member")
 
     friends = db.relationship(
         "User",
@@ -37,10 +37,17 @@ class User(db.Model):
     def __init__(self, username, email, password):
         self.name = username
         self.email = email
-        self.password = generate_password_hash(password, "pbkdf2:sha256")
+        self.password = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return check_password(self.password, password)
+
+    def rehash_password(self, password):
+        """Re-hash a just checked password if the hash method changed"""
+        if not needs_rehash(self.password):
+            return False
+        self.password = hash_password(password)
+        return True
 
     def __str__(self):
         return self.name
@@ -58,8 +65,8 @@ class RoomRead(db.Model):
     room_id = db.Column(db.Integer, db.ForeignKey("chat_rooms.id"), primary_key=True)
     is_read = db.Column(db.Boolean, default=False)
     is_to_email = db.Column(db.Boolean, default=False)
-    last_read = db.Column(db.String(25))
-    last_modified = db.Column(db.String(50))
+    last_read_at = db.Column(db.DateTime)
+    last_read_id = db.Column(db.Integer, default=0)
     room_name = db.Column(db.String(50))
 
     member = relationship("User", back_populates="chat_rooms")
@@ -68,9 +75,10 @@ class RoomRead(db.Model):
 
 class Chat(db.Model):
     __tablename__ = "chats"
+    __table_args__ = (db.Index("ix_chats_room_id_id", "room_id", "id"),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     message = db.Column(db.Text)
-    time = db.Column(db.String(25))
+    created_at = db.Column(db.DateTime, index=True)
     is_image = db.Column(db.Boolean, default=False)
 
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -85,7 +93,7 @@ class ChatRoom(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     chats = relationship("Chat", back_populates="room", lazy="dynamic")
     name = db.Column(db.String(25))
-    last_modified = db.Column(db.String(50))
+    modified_at = db.Column(db.DateTime)
     is_group = db.Column(db.Boolean, default=False)
     members = relationship("RoomRead", back_populates="chat_room")
 
@@ -95,7 +103,7 @@ class ChatRoom(db.Model):
         return f"<ChatRoom {self.id}>"
 
     def get_dict(self):
-        return {"id": self.id, "name": self.name, "last_modified": last_modified}
+        return {"id": self.id, "name": self.name, "last_modified": self.modified_at}
 
 
 class BlogPost(db.Model):
@@ -121,6 +129,7 @@ class BlogPost(db.Model):
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (db.Index("ix_comments_post_id_id", "post_id", "id"),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -152,7 +161,9 @@ class Image(db.Model):
     __tablename__ = "images"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     filename = db.Column(db.String(100), nullable=False)
-    img = db.Column(db.LargeBinary, nullable=False)
+    # Content lives in the blob store (util/blob_store.py) under its sha256
+    digest = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer)
     mimetype = db.Column(db.String(100), nullable=False)
 
     def __str__(self):
@@ -162,7 +173,8 @@ class Image(db.Model):
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     filename = db.Column(db.String(100), nullable=False)
-    file = db.Column(db.LargeBinary, nullable=False)
+    digest = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer)
     mimetype = db.Column(db.String(100), nullable=False)
     owner_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     file_owner = relationship("User", back_populates="files")
@@ -2,7 +2,10 @@ from datetime import datetime, timedelta
 
 
 def get_jkt_timezone():
-    utc = datetime.utcnow()
+    return to_jkt_timezone(datetime.utcnow())
+
+
+def to_jkt_timezone(utc):
     return utc + timedelta(hours=7)
 
 
@@ -0,0 +1,138 @@
+"""NDJSON export and import of blog posts and comments.
+
+Every line is one row: ``{"type": "post" | "comment", <column>: <value>}``
+with every column of the table, ids included. An import only sets the
+columns a line has, the others get their defaults. Posts come before comments so
+an import can insert the file in order.
+
+``export_lines`` reads each table through a streaming cursor (a named
+server-side cursor on PostgreSQL) and ``fetchmany`` batches, so memory use
+doesn't grow with the table. ``import_lines`` inserts the rows in batches of
+``BATCH_SIZE`` with one executemany each, all inside one transaction: a bad
+line rolls the whole import back.
+"""
+
+from sqlalchemy import exc
+from models import db, BlogPost, Comment
+from util.serializers import dumps
+import json
+
+BATCH_SIZE = 1000
+
+# type -> table, in import order
+TABLES = {
+    "post": BlogPost.__table__,
+    "comment": Comment.__table__,
+}
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def export_lines(batch_size=BATCH_SIZE):
+    """Yield the NDJSON lines of every post and comment"""
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for kind, table in TABLES.items():
+            result = conn.execute(table.select().order_by(table.c.id))
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield b"".join(
+                    dumps({"type": kind, **dict(row)}) + b"\n" for row in rows
+                )
+
+
+def get_wrong_types(table, record):
+    """Return the columns of record whose value doesn't fit the column type"""
+    wrong = []
+    for name, value in record.items():
+        if value is None:
+            continue
+        python_type = table.c[name].type.python_type
+        # bool is an int, but not a valid id or count
+        if isinstance(value, bool) and python_type is not bool:
+            wrong.append(name)
+        elif not isinstance(value, python_type):
+            wrong.append(name)
+        elif python_type is int and not -(2**63) <= value < 2**63:
+            wrong.append(name)
+    return wrong
+
+
+def reset_sequence(conn, table):
+    """Move a PostgreSQL serial past the ids that were inserted explicitly"""
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            db.text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"
+            )
+        )
+
+
+def import_lines(lines, batch_size=BATCH_SIZE, on_batch=None):
+    """Insert the rows of an NDJSON export in one transaction. Calls
+    on_batch(kind, rows, total) after each batch and returns the number of
+    rows inserted per kind. Raises InvalidRecord for a malformed line or a
+    value that doesn't fit its column."""
+    batches = {kind: [] for kind in TABLES}
+    # Line numbers of the first and last row of each batch, for errors
+    first_lines = {}
+    last_lines = {}
+    totals = dict.fromkeys(TABLES, 0)
+
+    def insert(conn, kind):
+        rows = batches[kind]
+        if not rows:
+            return
+        try:
+            conn.execute(TABLES[kind].insert(), rows)
+        except exc.IntegrityError:
+            raise
+        except exc.StatementError as e:
+            # Values the database rejects, too long for the column and such
+            raise InvalidRecord(
+                f"Lines {first_lines[kind]}-{last_lines[kind]}: {e.orig}"
+            )
+        totals[kind] += len(rows)
+        batches[kind] = []
+        if on_batch:
+            on_batch(kind, len(rows), totals[kind])
+
+    with db.engine.begin() as conn:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                table = TABLES[record["type"]]
+            except (ValueError, TypeError, KeyError):
+                raise InvalidRecord(f"Line {number}: not a post or comment")
+            unknown = set(record) - set(table.c.keys()) - {"type"}
+            if unknown:
+                raise InvalidRecord(f"Line {number}: unknown columns {sorted(unknown)}")
+            kind = record["type"]
+            del record["type"]
+            wrong = get_wrong_types(table, record)
+            if wrong:
+                raise InvalidRecord(f"Line {number}: wrong type for {sorted(wrong)}")
+            if kind == "comment" and batches["post"]:
+                # Comments point at posts, insert those first
+                insert(conn, "post")
+            if batches[kind] and batches[kind][0].keys() != record.keys():
+                # One executemany needs the same columns in every row
+                insert(conn, kind)
+            if not batches[kind]:
+                first_lines[kind] = number
+            last_lines[kind] = number
+            batches[kind].append(record)
+            if len(batches[kind]) >= batch_size:
+                insert(conn, kind)
+        for kind, table in TABLES.items():
+            insert(conn, kind)
+            if totals[kind]:
+                reset_sequence(conn, table)
+    return totals
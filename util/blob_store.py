@@ -0,0 +1,93 @@
+"""Content-addressed storage for uploaded images and files.
+
+Blobs are stored on disk under the sha256 of their content
+(``<root>/ab/cd/abcd...``), so identical uploads share one file and the
+database rows only keep the digest, size and metadata.
+"""
+
+import hashlib
+import os
+import tempfile
+from models import db, Image, File
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore:
+    def __init__(self, root=None):
+        self.root = root
+
+    def init_app(self, app):
+        self.root = app.config["BLOB_STORE_PATH"]
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        """Store bytes or a binary file object, return (digest, size)"""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            digest = hashlib.sha256(data).hexdigest()
+            if not self.exists(digest):
+                self._write(digest, [bytes(data)])
+            return digest, len(data)
+
+        # Stream into a temporary file while hashing, then move it in place
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in iter(lambda: data.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            digest = sha256.hexdigest()
+            if self.exists(digest):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+                os.replace(tmp_path, self.path(digest))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, size
+
+    def _write(self, digest, chunks):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as tmp:
+            for chunk in chunks:
+                tmp.write(chunk)
+        os.replace(tmp_path, path)
+
+    def read(self, digest):
+        with open(self.path(digest), "rb") as file:
+            return file.read()
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+
+blob_store = BlobStore()
+
+
+def release_blobs(digests):
+    """Delete the blobs no Image or File row points at anymore. Call this after
+    the rows are committed, since blobs are shared between rows."""
+    for digest in set(digests):
+        if not digest:
+            continue
+        if db.session.query(Image.id).filter_by(digest=digest).first():
+            continue
+        if db.session.query(File.id).filter_by(digest=digest).first():
+            continue
+        blob_store.delete(digest)
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+import time
+
+# name -> TTLCache, for exporting cache stats
+caches = {}
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire ``ttl`` seconds after they
+    were set"""
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if name:
+            caches[name] = self
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.data[key] = (time.monotonic() + ttl, value)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,100 @@
+"""Engine settings picked from the database URI.
+
+SQLite connections get WAL journaling and the PRAGMAs below when they are
+opened, and are pooled instead of reopened for every checkout. Postgres gets
+a pool sized for one gevent worker serving many greenlets at once.
+"""
+
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+SQLITE_PRAGMAS = {
+    # Readers no longer wait for the writer, and commits only fsync the WAL
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    # Milliseconds to wait for the write lock instead of failing right away
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative means KiB, so 64 MiB of page cache per connection
+    "cache_size": -64 * 1024,
+}
+
+
+def get_engine_options(uri, pool_size=10, max_overflow=20):
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        if not url.database or url.database == ":memory:":
+            return {}
+        return {
+            "poolclass": QueuePool,
+            "pool_size": 5,
+            "max_overflow": 10,
+            "connect_args": {"check_same_thread": False},
+        }
+    if url.get_backend_name() in ("postgresql", "postgres"):
+        return {
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            # Greenlets waiting for a connection give up instead of piling up
+            "pool_timeout": 10,
+            # Drop connections the server or a proxy closed while idle
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        }
+    return {}
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+# Set by patch_psycopg
+green_psycopg = False
+
+
+def patch_psycopg():
+    """Make psycopg2 wait on the gevent hub instead of blocking the worker,
+    when running under gevent and psycogreen is installed"""
+    global green_psycopg
+    try:
+        from gevent import monkey
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    if monkey.is_module_patched("socket") and not green_psycopg:
+        patch_psycopg()
+        green_psycopg = True
+
+
+def describe_engine(engine):
+    """One line with the settings the engine actually runs with"""
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as conn:
+            settings = [
+                f"{name}={conn.execute(f'PRAGMA {name}').scalar()}"
+                for name in SQLITE_PRAGMAS
+            ]
+    else:
+        settings = []
+    pool = engine.pool
+    settings.append(f"pool={type(pool).__name__}")
+    if isinstance(pool, QueuePool):
+        settings += [
+            f"pool_size={pool.size()}",
+            f"max_overflow={pool._max_overflow}",
+            f"pool_timeout={pool._timeout}",
+            f"pool_recycle={pool._recycle}",
+            f"pre_ping={pool._pre_ping}",
+        ]
+    if engine.dialect.name == "postgresql":
+        settings.append(f"green_psycopg={green_psycopg}")
+    return f"Database {engine.url!r}: " + ", ".join(settings)
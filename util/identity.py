@@ -0,0 +1,42 @@
+"""Cache of the users looked up for JWT-authenticated requests.
+
+The column values of each user are cached for a short TTL and rebuilt into a
+session-attached ``User`` without a query, so relationships and comparisons
+with other loaded objects keep working. Entries are dropped whenever a user
+row is inserted, updated or deleted through the ORM in this process; with
+several workers other processes may serve a stale row for up to the TTL.
+"""
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from models import db, User
+from util.cache import TTLCache
+
+user_cache = TTLCache(maxsize=1024, ttl=60, name="users")
+
+
+def get_columns(user):
+    return {
+        column.key: getattr(user, column.key) for column in User.__mapper__.column_attrs
+    }
+
+
+def load_user(user_id):
+    columns = user_cache.get(user_id)
+    if columns is None:
+        user = User.query.filter_by(id=user_id).one_or_none()
+        if user:
+            user_cache.set(user_id, get_columns(user))
+        return user
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in columns.items():
+        setattr(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
@@ -0,0 +1,314 @@
+"""In-process metrics in the Prometheus text format.
+
+Requests to the api blueprint (``instrument_blueprint``) and socket.io
+events (``InstrumentedSocketIO``) record their latency, the number and time
+of the SQL statements they ran, payload sizes and errors. Gauges are read
+when the metrics are rendered. Values are per process; with several workers
+every worker has to be scraped.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+from flask import request
+from flask_socketio import SocketIO
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from util.cache import caches
+from util.offload import pools
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield (
+                    self.name + "_bucket",
+                    format_labels(self.labelnames + ("le",), labels + (bound,)),
+                    cumulative,
+                )
+            label_text = format_labels(self.labelnames, labels)
+            yield self.name + "_sum", label_text, total
+            yield self.name + "_count", label_text, cumulative
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames, collect):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        # Returns {labels tuple: value}
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class CounterFunc(Gauge):
+    """Counter kept by someone else (a pool, a cache), read when rendered"""
+
+    type = "counter"
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, collect):
+        return self.add(Gauge(name, help, labelnames, collect))
+
+    def counter_func(self, name, help, labelnames, collect):
+        return self.add(CounterFunc(name, help, labelnames, collect))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# SQL statements are added to the scope of the request or event running on
+# this thread (greenlet under gevent)
+local = threading.local()
+
+
+def start_scope():
+    local.scope = {"start": time.perf_counter(), "sql_count": 0, "sql_time": 0.0}
+
+
+def end_scope():
+    scope = getattr(local, "scope", None)
+    local.scope = None
+    if scope:
+        scope["duration"] = time.perf_counter() - scope["start"]
+    return scope
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["query_start"].pop()
+    scope = getattr(local, "scope", None)
+    if scope:
+        scope["sql_count"] += 1
+        scope["sql_time"] += time.perf_counter() - start
+
+
+http_duration = metrics.histogram(
+    "http_request_duration_seconds", "API request latency", ("endpoint", "method")
+)
+http_requests = metrics.counter(
+    "http_requests_total", "API requests", ("endpoint", "method", "status")
+)
+http_errors = metrics.counter(
+    "http_request_errors_total", "API requests that failed with 5xx", ("endpoint",)
+)
+http_sql_count = metrics.histogram(
+    "http_request_sql_statements",
+    "SQL statements per API request",
+    ("endpoint",),
+    COUNT_BUCKETS,
+)
+http_sql_time = metrics.histogram(
+    "http_request_sql_seconds", "Time spent in SQL per API request", ("endpoint",)
+)
+http_request_size = metrics.histogram(
+    "http_request_size_bytes", "API request body size", ("endpoint",), SIZE_BUCKETS
+)
+http_response_size = metrics.histogram(
+    "http_response_size_bytes", "API response body size", ("endpoint",), SIZE_BUCKETS
+)
+
+
+def instrument_blueprint(blueprint):
+    @blueprint.before_request
+    def start_request_metrics():
+        start_scope()
+
+    @blueprint.after_request
+    def record_request_metrics(response):
+        scope = end_scope()
+        if not scope:
+            return response
+        endpoint = request.endpoint or "unknown"
+        http_duration.observe(scope["duration"], endpoint, request.method)
+        http_requests.inc(endpoint, request.method, response.status_code)
+        if response.status_code >= 500:
+            http_errors.inc(endpoint)
+        http_sql_count.observe(scope["sql_count"], endpoint)
+        http_sql_time.observe(scope["sql_time"], endpoint)
+        http_request_size.observe(request.content_length or 0, endpoint)
+        http_response_size.observe(response.content_length or 0, endpoint)
+        return response
+
+
+event_duration = metrics.histogram(
+    "socketio_event_duration_seconds",
+    "Socket.IO handler latency",
+    ("namespace", "event"),
+)
+event_errors = metrics.counter(
+    "socketio_event_errors_total",
+    "Socket.IO handlers that raised",
+    ("namespace", "event"),
+)
+event_sql_count = metrics.histogram(
+    "socketio_event_sql_statements",
+    "SQL statements per Socket.IO event",
+    ("namespace", "event"),
+    COUNT_BUCKETS,
+)
+event_sql_time = metrics.histogram(
+    "socketio_event_sql_seconds",
+    "Time spent in SQL per Socket.IO event",
+    ("namespace", "event"),
+)
+event_payload_size = metrics.histogram(
+    "socketio_event_payload_bytes",
+    "Socket.IO event payload size",
+    ("namespace", "event"),
+    SIZE_BUCKETS,
+)
+
+
+def payload_size(value):
+    """Approximate size of an event payload, without encoding it on the hub"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value) if value.isascii() else len(value.encode())
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(item) for item in value)
+    # Numbers, booleans and None
+    return len(str(value))
+
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO that records metrics for every event handler it runs.
+
+    Overrides the private ``SocketIO._handle_event`` of Flask-SocketIO 5.3.7
+    (pinned in requirements.txt), check its signature before upgrading."""
+
+    def _handle_event(self, handler, message, namespace, sid, *args):
+        start_scope()
+        try:
+            return super()._handle_event(handler, message, namespace, sid, *args)
+        except Exception:
+            event_errors.inc(namespace, message)
+            raise
+        finally:
+            scope = end_scope()
+            event_duration.observe(scope["duration"], namespace, message)
+            event_sql_count.observe(scope["sql_count"], namespace, message)
+            event_sql_time.observe(scope["sql_time"], namespace, message)
+            # connect gets the WSGI environ, not a payload
+            if message not in ("connect", "disconnect"):
+                event_payload_size.observe(payload_size(args), namespace, message)
+
+
+def pool_stat(key):
+    return lambda: {(name,): pool.stats()[key] for name, pool in pools.items()}
+
+
+def cache_stat(key):
+    return lambda: {(name,): cache.stats()[key] for name, cache in caches.items()}
+
+
+for key, help in (
+    ("size", "Threads in the worker pool"),
+    ("pending", "Calls waiting for a worker pool result"),
+    ("queue_depth", "Calls queued behind busy worker pool threads"),
+    (
+        "max_pending",
+        "High-water mark of calls waiting for the worker pool at once, since "
+        "the process started",
+    ),
+):
+    metrics.gauge(f"worker_pool_{key}", help, ("pool",), pool_stat(key))
+metrics.counter_func(
+    "worker_pool_completed_total",
+    "Calls the worker pool finished",
+    ("pool",),
+    pool_stat("completed"),
+)
+
+metrics.gauge("cache_size", "Entries in the cache", ("cache",), cache_stat("size"))
+metrics.counter_func("cache_hits_total", "Cache hits", ("cache",), cache_stat("hits"))
+metrics.counter_func(
+    "cache_misses_total", "Cache misses", ("cache",), cache_stat("misses")
+)
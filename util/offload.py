@@ -0,0 +1,71 @@
+"""Run CPU-bound work (image encoding, password hashing) on native threads.
+
+The app is served by a single gevent worker, so anything CPU-bound that runs
+on the hub freezes every open socket until it finishes. A ``WorkerPool`` runs
+the function on one of ``size`` real OS threads and only the calling greenlet
+waits for the result. PIL and hashlib release the GIL while they work, so the
+hub keeps serving other requests meanwhile.
+
+Outside of gevent (tests, the threading async mode) a plain
+``ThreadPoolExecutor`` is used instead.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def gevent_is_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+# name -> WorkerPool, for exporting pool stats
+pools = {}
+
+
+class WorkerPool:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._pool = None
+        self._uses_gevent = False
+        # Counted on the calling side: calls waiting for a result, the most
+        # ever waiting at once, and finished calls
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        pools[name] = self
+
+    def _get_pool(self):
+        if self._pool is None:
+            if gevent_is_patched():
+                from gevent.threadpool import ThreadPool
+
+                self._pool = ThreadPool(self.size)
+                self._uses_gevent = True
+            else:
+                self._pool = ThreadPoolExecutor(self.size)
+        return self._pool
+
+    def run(self, fn, *args, **kwargs):
+        pool = self._get_pool()
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        try:
+            if self._uses_gevent:
+                return pool.apply(fn, args, kwargs)
+            return pool.submit(fn, *args, **kwargs).result()
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "pending": self.pending,
+            "queue_depth": max(0, self.pending - self.size),
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+        }
@@ -0,0 +1,28 @@
+"""Password hashing on the worker thread pool.
+
+PBKDF2 takes tens of milliseconds of CPU per call, which would stall every
+socket served by the gevent worker if it ran on the hub. Hashes made with an
+older PASSWORD_HASH_METHOD are upgraded the next time the password is checked.
+"""
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from util.offload import WorkerPool
+
+password_pool = WorkerPool("passwords", 2)
+
+
+def get_method():
+    return current_app.config["PASSWORD_HASH_METHOD"]
+
+
+def hash_password(password):
+    return password_pool.run(generate_password_hash, password, get_method())
+
+
+def check_password(pwhash, password):
+    return password_pool.run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return not pwhash.startswith(get_method() + "$")
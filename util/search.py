@@ -0,0 +1,181 @@
+"""Full-text search over blog posts and chat messages.
+
+SQLite uses FTS5 tables with blog_posts and chats as external content, kept
+current by triggers, so every path that writes posts or chats updates the
+index in the same transaction. Postgres uses GIN expression indexes over
+``to_tsvector``, which Postgres maintains by itself. ``create_index`` is run
+by the migrations and after ``db.create_all``.
+
+Queries are reduced to their words; every word has to match and the last
+one may be a prefix ("flask sock" finds "flask socketio").
+"""
+
+import re
+from sqlalchemy import event
+from models import db
+
+MAX_QUERY_WORDS = 8
+
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE posts_fts USING fts5"
+    "(title, subtitle, body, content='blog_posts', content_rowid='id')",
+    "CREATE VIRTUAL TABLE chats_fts USING fts5"
+    "(message, content='chats', content_rowid='id')",
+    """CREATE TRIGGER posts_fts_insert AFTER INSERT ON blog_posts BEGIN
+        INSERT INTO posts_fts (rowid, title, subtitle, body)
+        VALUES (new.id, new.title, new.subtitle, new.body);
+    END""",
+    """CREATE TRIGGER posts_fts_delete AFTER DELETE ON blog_posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, subtitle, body)
+        VALUES ('delete', old.id, old.title, old.subtitle, old.body);
+    END""",
+    """CREATE TRIGGER posts_fts_update AFTER UPDATE OF title, subtitle, body
+    ON blog_posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, subtitle, body)
+        VALUES ('delete', old.id, old.title, old.subtitle, old.body);
+        INSERT INTO posts_fts (rowid, title, subtitle, body)
+        VALUES (new.id, new.title, new.subtitle, new.body);
+    END""",
+    """CREATE TRIGGER chats_fts_insert AFTER INSERT ON chats BEGIN
+        INSERT INTO chats_fts (rowid, message) VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER chats_fts_delete AFTER DELETE ON chats BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, message)
+        VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER chats_fts_update AFTER UPDATE OF message ON chats BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, message)
+        VALUES ('delete', old.id, old.message);
+        INSERT INTO chats_fts (rowid, message) VALUES (new.id, new.message);
+    END""",
+    "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+    "INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')",
+]
+
+# Title matches weigh most, body matches least
+POSTGRES_POST_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(blog_posts.title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(blog_posts.subtitle, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(blog_posts.body, '')), 'D')"
+)
+POSTGRES_CHAT_VECTOR = "to_tsvector('simple', coalesce(chats.message, ''))"
+
+POSTGRES_INDEX = [
+    "CREATE INDEX IF NOT EXISTS ix_blog_posts_search ON blog_posts "
+    f"USING GIN (({POSTGRES_POST_VECTOR}))",
+    "CREATE INDEX IF NOT EXISTS ix_chats_search ON chats "
+    f"USING GIN (({POSTGRES_CHAT_VECTOR}))",
+]
+
+
+def create_index(conn):
+    if conn.dialect.name == "sqlite":
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'"
+        ).first()
+        if not exists:
+            for statement in SQLITE_INDEX:
+                conn.execute(statement)
+    elif conn.dialect.name == "postgresql":
+        for statement in POSTGRES_INDEX:
+            conn.execute(statement)
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def create_index_after_create_all(target, conn, **kw):
+    create_index(conn)
+
+
+def get_words(query):
+    return re.findall(r"\w+", query or "")[:MAX_QUERY_WORDS]
+
+
+def to_match_query(words, dialect):
+    if dialect == "postgresql":
+        return " & ".join(words) + ":*"
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def search_posts(words, include_hidden=False, exclude_ids=(), limit=20, offset=0):
+    """Return rows of (id, title, subtitle, date, author), best match first"""
+    dialect = db.engine.dialect.name
+    where = ""
+    if not include_hidden:
+        where += " AND (blog_posts.hidden IS NULL OR blog_posts.hidden = :false)"
+    if exclude_ids:
+        where += " AND blog_posts.id NOT IN :exclude_ids"
+    if dialect == "postgresql":
+        sql = (
+            "SELECT blog_posts.id, blog_posts.title, blog_posts.subtitle, "
+            "blog_posts.date, users.name AS author "
+            "FROM blog_posts LEFT JOIN users ON users.id = blog_posts.author_id "
+            f"WHERE {POSTGRES_POST_VECTOR} @@ to_tsquery('simple', :query){where} "
+            f"ORDER BY ts_rank({POSTGRES_POST_VECTOR}, "
+            "to_tsquery('simple', :query)) DESC, blog_posts.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        )
+    else:
+        sql = (
+            "SELECT blog_posts.id, blog_posts.title, blog_posts.subtitle, "
+            "blog_posts.date, users.name AS author "
+            "FROM posts_fts JOIN blog_posts ON blog_posts.id = posts_fts.rowid "
+            "LEFT JOIN users ON users.id = blog_posts.author_id "
+            f"WHERE posts_fts MATCH :query{where} "
+            "ORDER BY bm25(posts_fts, 10.0, 5.0, 1.0), blog_posts.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        )
+    statement = db.text(sql)
+    if exclude_ids:
+        statement = statement.bindparams(db.bindparam("exclude_ids", expanding=True))
+    return db.session.execute(
+        statement,
+        {
+            "query": to_match_query(words, dialect),
+            "false": False,
+            "exclude_ids": list(exclude_ids),
+            "limit": limit,
+            "offset": offset,
+        },
+    ).fetchall()
+
+
+def search_chats(words, user_id, limit=20, offset=0):
+    """Return rows of (id, room_id, room_name, message, username, created_at)
+    from the rooms the user is a member of, best match first"""
+    dialect = db.engine.dialect.name
+    columns = (
+        "SELECT chats.id, chats.room_id, room_read.room_name, chats.message, "
+        "users.name AS username, chats.created_at "
+    )
+    joins = (
+        "JOIN room_read ON room_read.room_id = chats.room_id "
+        "AND room_read.user_id = :user_id "
+        "LEFT JOIN users ON users.id = chats.user_id "
+    )
+    not_image = "AND (chats.is_image IS NULL OR chats.is_image = :false) "
+    if dialect == "postgresql":
+        sql = (
+            f"{columns}FROM chats {joins}"
+            f"WHERE {POSTGRES_CHAT_VECTOR} @@ to_tsquery('simple', :query) "
+            f"{not_image}"
+            f"ORDER BY ts_rank({POSTGRES_CHAT_VECTOR}, "
+            "to_tsquery('simple', :query)) DESC, chats.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        )
+    else:
+        sql = (
+            f"{columns}FROM chats_fts JOIN chats ON chats.id = chats_fts.rowid "
+            f"{joins}WHERE chats_fts MATCH :query {not_image}"
+            "ORDER BY bm25(chats_fts), chats.id DESC LIMIT :limit OFFSET :offset"
+        )
+    statement = db.text(sql).columns(created_at=db.DateTime)
+    return db.session.execute(
+        statement,
+        {
+            "query": to_match_query(words, dialect),
+            "user_id": user_id,
+            "false": False,
+            "limit": limit,
+            "offset": offset,
+        },
+    ).fetchall()
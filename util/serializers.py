@@ -0,0 +1,77 @@
+"""Per-model serializers, built once per model and set of excluded columns.
+
+Unlike ``row2dict`` values keep their JSON types (ints, bools, null) and
+datetimes become ISO 8601 strings. ``json_response`` encodes with orjson when
+it is installed and falls back to ``jsonify``.
+"""
+
+from datetime import date, datetime
+from functools import lru_cache
+import json
+from operator import attrgetter
+from flask import current_app, jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+@lru_cache(maxsize=None)
+def get_serializer(model, exclude=()):
+    """Return a function turning a ``model`` instance into a dict of its
+    columns, leaving out the column names in ``exclude`` (a tuple)"""
+    names = []
+    keys = []
+    converters = []
+    for attr in model.__mapper__.column_attrs:
+        column = attr.columns[0]
+        if column.name in exclude:
+            continue
+        names.append(column.name)
+        keys.append(attr.key)
+        python_type = getattr(column.type, "python_type", None)
+        if python_type in (datetime, date):
+            converters.append((len(names) - 1, isoformat))
+    get_values = attrgetter(*keys)
+
+    if len(keys) == 1:
+        name = names[0]
+        convert = converters[0][1] if converters else None
+        if convert:
+            return lambda row: {name: convert(get_values(row))}
+        return lambda row: {name: get_values(row)}
+
+    if not converters:
+        return lambda row: dict(zip(names, get_values(row)))
+
+    def serialize(row):
+        values = list(get_values(row))
+        for index, convert in converters:
+            values[index] = convert(values[index])
+        return dict(zip(names, values))
+
+    return serialize
+
+
+def serialize(row, exclude=()):
+    return get_serializer(type(row), tuple(exclude))(row)
+
+
+def dumps(data):
+    """Encode to JSON bytes, with orjson when it is installed"""
+    if orjson is None:
+        return json.dumps(data, separators=(",", ":")).encode()
+    return orjson.dumps(data)
+
+
+def json_response(data, status=200):
+    if orjson is None:
+        return jsonify(data), status
+    return current_app.response_class(
+        orjson.dumps(data), status=status, mimetype="application/json"
+    )
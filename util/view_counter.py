@@ -0,0 +1,76 @@
+"""Buffered post view counts.
+
+Reading a post used to commit ``views += 1`` on every request, which turns a
+read into a write transaction (and on SQLite makes every reader wait for the
+write lock). Views are counted in memory per post instead and added to
+``blog_posts.views`` in one batched UPDATE every ``VIEW_FLUSH_INTERVAL``
+seconds and when the process exits.
+
+At most one interval of views is lost if the process dies without running
+its exit handlers (SIGKILL, OOM, power loss). A failed flush puts the counts
+back to be retried with the next one.
+"""
+
+from collections import Counter
+import atexit
+import threading
+import time
+from models import db
+
+UPDATE_VIEWS = db.text(
+    "UPDATE blog_posts SET views = COALESCE(views, 0) + :delta WHERE id = :id"
+)
+
+
+class ViewCounter:
+    def __init__(self):
+        self.app = None
+        self.interval = 5
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config["VIEW_FLUSH_INTERVAL"]
+        atexit.register(self.flush)
+
+    def add(self, post_id):
+        with self.lock:
+            self.counts[post_id] += 1
+        if self.flusher is None:
+            # Started on first use so forked workers each get their own
+            self.flusher = threading.Thread(target=self.run, daemon=True)
+            self.flusher.start()
+
+    def pending(self, post_id):
+        """Views of the post not written to the database yet"""
+        return self.counts.get(post_id, 0)
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        if not counts:
+            return
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(
+                        UPDATE_VIEWS,
+                        [{"id": id, "delta": delta} for id, delta in counts.items()],
+                    )
+        except Exception:
+            with self.lock:
+                self.counts.update(counts)
+            raise
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print("Failed to flush post views:", e)
+
+
+view_counter = ViewCounter()